@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.express as px
-from calculator import EffectCalculator
+from calculator import EffectCalculator, PERIOD_STATUS_LABELS
 from report_generator import WordReportGenerator
 from presentation_builder import (
     build_stats_data,
@@ -14,9 +14,78 @@ from pdf_generator import export_html_to_pdf
 import io
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import datetime
 from pathlib import Path
 import tempfile
+import hashlib
+import datetime
+from dataclasses import dataclass
+from functools import partial
+
+# Copy-on-Write: срезы/rename дают ленивые копии, копирование — только при записи
+pd.set_option('mode.copy_on_write', True)
+
+# Размеры страницы таблицы активации цен
+ACT_PAGE_SIZES = (50, 200, 1000)
+
+# Таблица отбора недель в разделе 5 отчёта (статусы — PERIOD_STATUS_LABELS из calculator)
+FINAL_SELECTION_COLS = ('week_formatted', 'avg_stock', 'Статус', 'Включена в тест', 'Включена в базу')
+FINAL_SELECTION_RENAME = {'week_formatted': 'Неделя', 'avg_stock': 'Средний остаток'}
+
+# Таблицы раздела 6 отчёта (колонка get_simple_effect_details -> заголовок): тест, КГ, чистый прирост, абс. эффект
+EFFECT_TABLE_COLUMNS = (
+    {
+        'Fact_Revenue_Real': 'Выручка (Test)',
+        'PreTest_Avg_Revenue': 'Выручка (Pre-Test Avg)',
+        'Uplift_Revenue_Pct': 'Прирост % (Rev)',
+        'Fact_Profit_Real': 'Прибыль (Test)',
+        'PreTest_Avg_Profit': 'Прибыль (Pre-Test Avg)',
+        'Uplift_Profit_Pct': 'Прирост % (Prof)'
+    },
+    {
+        'Control_Revenue_Real': 'Выручка (КГ)',
+        'Control_Avg_Revenue': 'Выручка (КГ База)',
+        'Control_Uplift_Revenue_Pct': 'Прирост % (КГ Rev)',
+        'Control_Profit_Real': 'Прибыль (КГ)',
+        'Control_Avg_Profit': 'Прибыль (КГ База)',
+        'Control_Uplift_Profit_Pct': 'Прирост % (КГ Prof)'
+    },
+    {
+        'Uplift_Revenue_Pct': 'Test % (Rev)',
+        'Control_Uplift_Revenue_Pct': 'Control % (Rev)',
+        'Net_Effect_Revenue_Pct': 'Чистый Эффект % (Rev)',
+        'Uplift_Profit_Pct': 'Test % (Prof)',
+        'Control_Uplift_Profit_Pct': 'Control % (Prof)',
+        'Net_Effect_Profit_Pct': 'Чистый Эффект % (Prof)'
+    },
+    {
+        'Net_Effect_Revenue_Pct': 'Чистый % (Rev)',
+        'Fact_Revenue_Real': 'Факт (Test Rev)',
+        'Net_Abs_Effect_Revenue': 'Абс. Эффект (Rev)',
+        'Net_Effect_Profit_Pct': 'Чистый % (Prof)',
+        'Fact_Profit_Real': 'Факт (Test Prof)',
+        'Net_Abs_Effect_Profit': 'Абс. Эффект (Prof)'
+    },
+)
+# Числа понедельных раскрывашек раздела 6: суммы как '1,234.56', приросты/эффекты как '+12.34%'
+EFFECT_MONEY_COLS = (
+    'Calc_Revenue', 'PreTest_Avg_Revenue', 'Calc_Profit', 'PreTest_Avg_Profit',
+    'Calc_Control_Revenue', 'Control_Avg_Revenue', 'Calc_Control_Profit', 'Control_Avg_Profit',
+    'Fact_Revenue_Real', 'Net_Abs_Effect_Revenue', 'Fact_Profit_Real', 'Net_Abs_Effect_Profit'
+)
+EFFECT_PCT_COLS = (
+    'Uplift_Revenue_Pct', 'Uplift_Profit_Pct',
+    'Control_Uplift_Revenue_Pct', 'Control_Uplift_Profit_Pct',
+    'Net_Effect_Revenue_Pct', 'Net_Effect_Profit_Pct'
+)
+# Шаблоны Markdown понедельных пояснений раздела 6 (подставляются уже отформатированные числа)
+UPLIFT_MD_TEMPLATE = (
+    "**Формула:** `{formula}`\n\n"
+    "*   **{fact_label}** {mode} = `{fact} ₽`\n"
+    "*   **{base_label}** (база) = `{base} ₽`\n\n"
+    "**Прирост (Uplift)** = `({fact} / {base}) - 1` = :{color}[**{uplift}**]"
+)
+ABS_EFFECT_MD_TEMPLATE = "`{pct}` * `{fact} ₽` = :green[**{effect} ₽**]"
+
 
 def _get_error_recommendation(err):
     """Рекомендации по типу ошибки."""
@@ -33,14 +102,478 @@ def _get_error_recommendation(err):
     return "Проверьте структуру файла по образцу S-Market.xlsx."
 
 
+def _sum_by_pid(df, col):
+    """Сумма col по product_id через np.unique + np.bincount (NaN считаются нулём, как в groupby.sum)."""
+    uniq, inv = np.unique(df['product_id'].to_numpy(), return_inverse=True)
+    totals = np.bincount(inv, weights=np.nan_to_num(df[col].to_numpy(np.float64)), minlength=len(uniq))
+    return dict(zip(uniq.tolist(), totals.tolist()))
+
+
+def _round_direction(label):
+    """Код направления округления по подписи из сайдбара."""
+    if label.startswith("Вверх"):
+        return "up"
+    if label.startswith("Вниз"):
+        return "down"
+    return "nearest"
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Настройки из формы сайдбара; неизменяемые и хэшируемые — годятся как ключ кэша."""
+    pre_test_weeks: int
+    pre_test_threshold: int
+    contiguous_pre_test: bool
+    use_stock_filter: bool
+    stock_threshold_pct: int
+    test_use_week_values: bool
+    activation_threshold: int
+    activation_use_rounding: bool
+    activation_round_value: int
+    activation_round_direction: str
+    activation_wap_from_change_date: bool
+    activation_min_days_threshold: int
+
+    def calculate_kwargs(self):
+        """Аргументы EffectCalculator.calculate()."""
+        return dict(
+            use_stock_filter=self.use_stock_filter,
+            stock_threshold_pct=self.stock_threshold_pct,
+            pre_test_weeks_count=self.pre_test_weeks,
+            pre_test_stock_threshold=self.pre_test_threshold,
+            contiguous_pre_test=self.contiguous_pre_test,
+            test_use_week_values=self.test_use_week_values,
+            activation_threshold=self.activation_threshold,
+            activation_use_rounding=self.activation_use_rounding,
+            activation_round_value=self.activation_round_value,
+            activation_round_direction=self.activation_round_direction,
+            activation_wap_from_change_date=self.activation_wap_from_change_date,
+            activation_min_days_threshold=self.activation_min_days_threshold,
+        )
+
+    def calc_params(self):
+        """Параметры расчёта для презентации (build_stats_data)."""
+        return {
+            "pre_test_weeks": self.pre_test_weeks,
+            "pre_test_threshold": self.pre_test_threshold,
+            "contiguous_pre_test": self.contiguous_pre_test,
+            "use_stock_filter": self.use_stock_filter,
+            "stock_threshold_pct": self.stock_threshold_pct,
+            "test_use_week_values": self.test_use_week_values,
+        }
+
+    def activation_params(self):
+        """Параметры get_activation_details и отчётов."""
+        return {
+            "threshold_pct": self.activation_threshold,
+            "use_rounding": self.activation_use_rounding,
+            "round_value": self.activation_round_value,
+            "round_direction": self.activation_round_direction,
+            "wap_from_change_date": self.activation_wap_from_change_date,
+            "min_days_threshold": self.activation_min_days_threshold,
+        }
+
+    def report_params(self):
+        """Параметры дотестового периода для WordReportGenerator."""
+        return {
+            'pre_test_weeks_count': self.pre_test_weeks,
+            'pre_test_stock_threshold': self.pre_test_threshold,
+            'contiguous_pre_test': self.contiguous_pre_test,
+            'test_use_week_values': self.test_use_week_values,
+        }
+
+
+def _row_style_frame(row_css, df):
+    """Кадр стилей формы df, где вся строка i получает row_css[i] — для Styler.apply(..., axis=None)."""
+    css = np.asarray(row_css, dtype=object)[:, None]
+    return pd.DataFrame(np.broadcast_to(css, df.shape), index=df.index, columns=df.columns)
+
+
+def _weekly_detail_styles(df, target_col, context='full'):
+    """Стили таблиц детализации недели для Styler.apply(..., axis=None).
+
+    Активные строки (context='price' — is_used, иначе Кол-во > 0) жирные, неактивные серые;
+    в строке «Итого» зеленым выделяется только target_col.
+    """
+    n_rows, n_cols = df.shape
+    is_total = df['Дата'].eq('Итого').to_numpy()
+    if context == 'price':
+        is_active = df['is_used'].to_numpy(dtype=bool) if 'is_used' in df.columns else np.zeros(n_rows, dtype=bool)
+    elif 'Кол-во' in df.columns:
+        is_active = pd.to_numeric(df['Кол-во'], errors='coerce').fillna(0).to_numpy() > 0
+    else:
+        is_active = np.zeros(n_rows, dtype=bool)
+
+    row_css = np.where(is_active, 'font-weight: bold', 'color: #aaaaaa').astype(object)
+    row_css[is_total] = ''
+    css = np.repeat(row_css[:, None], n_cols, axis=1)
+    if target_col in df.columns:
+        css[is_total, df.columns.get_loc(target_col)] = 'color: green; font-weight: bold'
+    return pd.DataFrame(css, index=df.index, columns=df.columns)
+
+
+def _fmt_or_dash(series, fmt):
+    """Форматирует непустые значения строкой fmt, пропуски заменяет на «-»."""
+    return series.map(fmt.format, na_action="ignore").where(series.notna(), "-")
+
+
+def _uplift_markdown(formula, fact_label, base_label, color, modes, facts, bases, uplifts):
+    """Понедельные пояснения прироста раздела 6 (одна строка Markdown на неделю) из предформатированных чисел."""
+    fill = UPLIFT_MD_TEMPLATE.format
+    return np.array([
+        fill(formula=formula, fact_label=fact_label, base_label=base_label, color=color,
+             mode=mode, fact=fact, base=base, uplift=uplift)
+        for mode, fact, base, uplift in zip(modes, facts, bases, uplifts)
+    ], dtype=object)
+
+
+def _net_effect_styles(df):
+    """Стили таблицы чистого прироста: колонки «Чистый Эффект %» зелёные при > 0, иначе красные."""
+    styles = pd.DataFrame('', index=df.index, columns=df.columns)
+    for col in ('Чистый Эффект % (Rev)', 'Чистый Эффект % (Prof)'):
+        styles[col] = np.where(
+            df[col].to_numpy(dtype=float) > 0,
+            'background-color: #90ee90; color: black; font-weight: bold',
+            'background-color: #ffcccc; color: black; font-weight: bold'
+        )
+    return styles
+
+
+def _abs_effect_styles(df):
+    """Стили таблицы абс. эффекта: строка ИТОГО жирная, «Абс. Эффект» зелёный/красный по знаку (ноль без заливки)."""
+    styles = pd.DataFrame('', index=df.index, columns=df.columns)
+    styles.loc[df['Неделя'].eq('ИТОГО').to_numpy(), :] = 'font-weight: bold'
+    for col in ('Абс. Эффект (Rev)', 'Абс. Эффект (Prof)'):
+        vals = df[col].to_numpy(dtype=float)
+        styles[col] = np.where(
+            vals != 0,
+            np.where(
+                vals > 0,
+                'background-color: #90ee90; color: black; font-weight: bold',
+                'background-color: #ffcccc; color: black; font-weight: bold'
+            ),
+            styles[col].to_numpy()
+        )
+    return styles
+
+
+@st.cache_data(show_spinner=False)
+def _load_methodology():
+    """Текст методологии; читается с диска один раз (FileNotFoundError не кэшируется)."""
+    return (Path(__file__).parent / "docs" / "METHODOLOGY.md").read_text(encoding="utf-8")
+
+
+def _with_activation_status(timeline, status_by_week):
+    """Добавляет в таймлайн колонку activation_status по словарю {week_start: Status} одного товара."""
+    timeline['activation_status'] = timeline['week_start'].map(status_by_week).fillna("").astype('category')
+    return timeline
+
+
+@st.cache_resource(show_spinner=False)
+def _load_calc(file_key, _file_bytes):
+    """Чтение и предобработка файла; кэшируется по хешу содержимого, чтобы не разбирать XLSX на каждом rerun."""
+    calc = EffectCalculator(io.BytesIO(_file_bytes))
+    try:
+        calc.preprocess()
+    except Exception as prep_err:
+        prep_err._debug_stage = 'preprocess'
+        raise
+    return calc
+
+
+@st.cache_resource(show_spinner=False)
+def _rows_by_pid(file_key, table, _df, sort_by):
+    """Строки таблицы калькулятора (table — имя атрибута), разложенные по product_id
+    и отсортированные по sort_by один раз на файл; только для чтения."""
+    return {pid: rows.sort_values(sort_by) for pid, rows in _df.groupby('product_id', sort=False)}
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _run_calc(file_key, settings, _calc):
+    """Расчёт эффекта; кэшируется по хешу файла и настройкам (Settings).
+    Считаем на копии: _calc общий для всех сессий (cache_resource) и не должен хранить чужие результаты."""
+    calc = _calc.with_results()
+    results = calc.calculate(**settings.calculate_kwargs())
+    return results, calc.get_summary()
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _processed_pids(file_key, settings, _results):
+    """Отсортированные ID товаров из результатов расчета (ключ кэша — как у _run_calc)."""
+    return list(np.unique(_results['product_id'].to_numpy()))
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _activation_details(file_key, params, _calc):
+    """get_activation_details с кэшем по хешу файла и кортежу пар параметров активации."""
+    return _calc.get_activation_details(**dict(params))
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _revaluation_analysis(file_key, params, _calc):
+    """analyze_revaluation_activation с кэшем по хешу файла и параметрам активации."""
+    params = dict(params)
+    return _calc.analyze_revaluation_activation(
+        activation_threshold=params["threshold_pct"],
+        use_rounding=params["use_rounding"],
+        round_value=params["round_value"],
+        round_direction=params["round_direction"],
+        wap_from_change_date=params["wap_from_change_date"],
+        min_days_threshold=params["min_days_threshold"]
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _weekly_report(file_key, pid, params, _calc):
+    """get_product_weekly_report_data с кэшем по файлу, товару и параметрам активации."""
+    return _calc.get_product_weekly_report_data(pid, dict(params))
+
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def _weekly_details(file_key, pid, week, params, _calc):
+    """get_weekly_details с кэшем по файлу, товару, неделе и параметрам активации."""
+    return _calc.get_weekly_details(pid, week, dict(params))
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _pre_test_details(file_key, pid, params, report_min, report_max, _calc):
+    """get_pre_test_selection_details с кэшем по файлу, товару, параметрам дотеста и диапазону отчёта."""
+    return _calc.get_pre_test_selection_details(pid, dict(params), report_min=report_min, report_max=report_max)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _simple_effect_details(file_key, settings, pid, _calc, _results):
+    """get_simple_effect_details с кэшем по файлу, настройкам (от них зависит _results) и товару;
+    результаты передаются явно, а не берутся из общего _calc."""
+    return _calc.get_simple_effect_details(
+        pid, use_week_values=settings.test_use_week_values, results_df=_results
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _effect_tables(file_key, settings, pid, _effect_details):
+    """Таблицы раздела 6 отчёта (тест, КГ, чистый прирост, абс. эффект с ИТОГО), стили двух последних
+    и предформатированные строки для понедельных раскрывашек; ключ — как у _simple_effect_details."""
+    # Один набор массивов колонок на все четыре таблицы; таблицы собираются из него без rename-копий
+    columns = {col: _effect_details[col].array for col in ('week_formatted', *{c for t in EFFECT_TABLE_COLUMNS for c in t})}
+    display_effect, display_control, display_net, display_abs_with_total = (
+        pd.DataFrame(
+            {'Неделя': columns['week_formatted'], **{name: columns[col] for col, name in spec.items()}},
+            index=_effect_details.index
+        )
+        for spec in EFFECT_TABLE_COLUMNS
+    )
+
+    # Total row: NaN-skipping sums for amounts (per-column, so integer columns stay integer)
+    # and means for percentages, appended in place
+    totals = []
+    for col in EFFECT_TABLE_COLUMNS[3]:
+        values = np.asarray(columns[col])
+        total = np.nansum(values)
+        if col.startswith('Net_Effect_'):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total = total / np.count_nonzero(~np.isnan(values))
+        totals.append(total)
+    display_abs_with_total.loc[len(display_abs_with_total)] = ['ИТОГО'] + totals
+
+    # Per-week expander inputs as plain arrays (widget key suffix, labels, preformatted numbers)
+    effect_text = {
+        'week_key': np.array([f"{pid}_{w:%Y%m%d}" for w in _effect_details['week_start']], dtype=object),
+        'week_formatted': _effect_details['week_formatted'].to_numpy(),
+        'Mode_Comment': _effect_details['Mode_Comment'].to_numpy(),
+        **{col: _effect_details[col].map('{:,.2f}'.format).to_numpy() for col in EFFECT_MONEY_COLS},
+        **{col: (_effect_details[col] * 100).map('{:+.2f}%'.format).to_numpy() for col in EFFECT_PCT_COLS},
+    }
+    # Formula markdown of the week expanders, built here so reruns only look it up
+    effect_text.update({
+        'test_revenue_md': _uplift_markdown(
+            '(Fact_Revenue / PreTest_Avg) - 1', 'Fact Revenue', 'Pre-Test Avg', 'green',
+            effect_text['Mode_Comment'], effect_text['Calc_Revenue'], effect_text['PreTest_Avg_Revenue'], effect_text['Uplift_Revenue_Pct']
+        ),
+        'test_profit_md': _uplift_markdown(
+            '(Fact_Profit / PreTest_Avg) - 1', 'Fact Profit', 'Pre-Test Avg', 'green',
+            effect_text['Mode_Comment'], effect_text['Calc_Profit'], effect_text['PreTest_Avg_Profit'], effect_text['Uplift_Profit_Pct']
+        ),
+        'control_revenue_md': _uplift_markdown(
+            '(Control_Fact / Control_Base) - 1', 'Control Fact', 'Control Base', 'blue',
+            effect_text['Mode_Comment'], effect_text['Calc_Control_Revenue'], effect_text['Control_Avg_Revenue'], effect_text['Control_Uplift_Revenue_Pct']
+        ),
+        'control_profit_md': _uplift_markdown(
+            '(Control_Fact / Control_Base) - 1', 'Control Fact', 'Control Base', 'blue',
+            effect_text['Mode_Comment'], effect_text['Calc_Control_Profit'], effect_text['Control_Avg_Profit'], effect_text['Control_Uplift_Profit_Pct']
+        ),
+        'abs_revenue_md': np.array([
+            ABS_EFFECT_MD_TEMPLATE.format(pct=pct, fact=fact, effect=effect)
+            for pct, fact, effect in zip(effect_text['Net_Effect_Revenue_Pct'], effect_text['Fact_Revenue_Real'], effect_text['Net_Abs_Effect_Revenue'])
+        ], dtype=object),
+        'abs_profit_md': np.array([
+            ABS_EFFECT_MD_TEMPLATE.format(pct=pct, fact=fact, effect=effect)
+            for pct, fact, effect in zip(effect_text['Net_Effect_Profit_Pct'], effect_text['Fact_Profit_Real'], effect_text['Net_Abs_Effect_Profit'])
+        ], dtype=object),
+    })
+
+    return (
+        display_effect, display_control, display_net, display_abs_with_total,
+        _net_effect_styles(display_net), _abs_effect_styles(display_abs_with_total),
+        effect_text
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _word_report(file_key, settings, pid, _calc, _results, _summary):
+    """Word-отчёт по товару (байты .docx); кэшируется по хешу файла, настройкам (от них зависят _results и summary)
+    и товару, чтобы документ не собирался заново на каждом rerun. Генератор работает с копией _calc,
+    привязанной к переданным _results."""
+    generator = WordReportGenerator(
+        _calc.with_results(_results),
+        pid,
+        settings.report_params(),
+        results_summary=_summary,
+        activation_params=settings.activation_params()
+    )
+    return generator.generate().getvalue()
+
+
+def _excel_cell(value):
+    """Значение ячейки по правилам to_excel: пропуски пустые, inf — строкой, нескалярные — str()."""
+    if isinstance(value, (np.integer, np.floating, np.bool_)):
+        value = value.item()
+    if isinstance(value, (str, bool, int, datetime.date)):
+        return value
+    if isinstance(value, float):
+        if np.isnan(value):
+            return None
+        return value if np.isfinite(value) else ('inf' if value > 0 else '-inf')
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    return str(value)
+
+
+def _write_sheet(writer, sheet_name, df):
+    """Лист xlsxwriter напрямую, колонками через write_column, минуя поячеечный ExcelFormatter pandas;
+    заголовок — как у to_excel(index=False), даты берут default_date_format книги."""
+    book = writer.book
+    sheet = book.add_worksheet(sheet_name)
+    sheet.write_row(0, 0, [str(col) for col in df.columns],
+                    book.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}))
+    for col_idx, col in enumerate(df.columns):
+        values = df[col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            cells = values.astype(object).where(values.notna(), None).tolist()
+        elif isinstance(values.dtype, np.dtype) and values.dtype.kind == 'f':
+            # Float metrics sanitized in one vectorized pass: NaN -> blank, ±inf -> 'inf' / '-inf'
+            floats = values.to_numpy()
+            cells = floats.astype(object)
+            cells[np.isnan(floats)] = None
+            cells[np.isposinf(floats)] = 'inf'
+            cells[np.isneginf(floats)] = '-inf'
+            cells = cells.tolist()
+        elif isinstance(values.dtype, np.dtype) and values.dtype.kind in 'iub':
+            cells = values.tolist()
+        else:
+            cells = [_excel_cell(value) for value in values.tolist()]
+        sheet.write_column(1, col_idx, cells)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _excel_export(file_key, settings, act_pid, _calc, _results, _summary, _activation_df):
+    """Полный Excel-отчёт (байты .xlsx); кэшируется по хешу файла, настройкам и товарному фильтру
+    вкладки активации (act_pid, он сужает лист Activation Analysis)."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(
+        buffer, engine='xlsxwriter', engine_kwargs={'options': {'default_date_format': 'YYYY-MM-DD HH:MM:SS'}}
+    ) as writer:
+        # Small sheets go through to_excel; the per-row ones through _write_sheet; empty sheets are skipped
+        if _summary:
+            pd.DataFrame([_summary]).to_excel(writer, sheet_name='Summary', index=False)
+        if not _results.empty:
+            _write_sheet(writer, 'Detailed Results', _results)
+
+        if not _activation_df.empty:
+            _write_sheet(writer, 'Activation Analysis', _activation_df)
+
+        control_df = _calc.get_control_group_info()
+        if not control_df.empty:
+            control_df.to_excel(writer, sheet_name='Control Group', index=False)
+
+        # Таймлайны строятся по results_df — берём их с копии, привязанной к _results
+        all_timelines = _calc.with_results(_results).get_all_product_timelines(_calc.sorted_test_product_ids)
+        if not all_timelines.empty:
+            _write_sheet(writer, 'Product Timelines', all_timelines)
+    return buffer.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _results_export(file_key, settings, fmt, _results):
+    """Детальные результаты (лист Detailed Results) в Parquet или Feather — быстрая выгрузка данных без XLSX;
+    ключ — как у _run_calc плюс формат."""
+    buffer = io.BytesIO()
+    if fmt == 'Parquet':
+        _results.to_parquet(buffer, engine='pyarrow', compression='zstd', index=False)
+    else:
+        # Feather stores no index, so it must be the default RangeIndex
+        _results.reset_index(drop=True).to_feather(buffer)
+    return buffer.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _file_bytes(path, mtime):
+    """Содержимое файла из static (презентация, PDF); кэшируется по пути и времени изменения."""
+    return Path(path).read_bytes()
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _presentation_pdf(html_digest, _html_path):
+    """PDF презентации (байты); кэшируется по хешу содержимого HTML, так что Chromium запускается
+    только для новой презентации, а не для каждого нового имени файла с тем же содержимым."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        return export_html_to_pdf(_html_path, Path(tmp_dir) / "presentation.pdf").read_bytes()
+
+
+def _save_presentation(calc, results, summary, activation_params, file_name, settings):
+    """Собирает HTML-презентацию по расчёту и сохраняет её в static (FIFO, последние 3); возвращает имя файла."""
+    stats_data = build_stats_data(calc, results, summary, activation_params, file_name, settings.calc_params())
+    # First non-excluded row's product: one boolean mask over the arrays, no frame copy or unique pass
+    valid_pids = results["product_id"].to_numpy()[~results["Is_Excluded"].to_numpy(dtype=bool)]
+    pid = int(valid_pids[0]) if len(valid_pids) > 0 else int(next(iter(calc.test_product_ids)))
+    pres_data = build_presentation_data(
+        calc, results, pid, activation_params,
+        use_week_values=settings.test_use_week_values,
+    )
+    html = generate_html(stats_data, pres_data)
+    return save_presentation_and_manage_history(html, Path(__file__).parent, max_history=3)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _reval_detail_by_date(file_key, params, _reval_detail):
+    """Детализация переоценок, разложенная по дате переоценки."""
+    if _reval_detail.empty:
+        return {}
+    return {date: sub for date, sub in _reval_detail.groupby('revaluation_date', sort=False)}
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _product_labels(file_key, pids, _product_names):
+    """Подписи «[id] название» для выпадающих списков товаров."""
+    return {pid: f"[{pid}] {_product_names.get(pid, 'Unknown')}" for pid in pids}
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _activation_metrics(file_key, params, _activation_df):
+    """Метрики вкладки активации: недель не по правилам, годных недель, товаров с нарушениями."""
+    can_use = _activation_df['Can_Use_In_Analysis'].to_numpy(dtype=bool)
+    can_use_weeks = int(can_use.sum())
+    products_with_not_ok = np.unique(_activation_df['product_id'].to_numpy()[~can_use]).size
+    return can_use.size - can_use_weeks, can_use_weeks, int(products_with_not_ok)
+
+
 st.set_page_config(page_title="Калькулятор Эффективности Ценообразования", layout="wide")
 
 st.title("KeepRise Lite: A/B Test Calculator")
 
 with st.expander("ℹ️ Методология (Читать)"):
     try:
-        with open("docs/METHODOLOGY.md", "r") as f:
-            st.markdown(f.read())
+        st.markdown(_load_methodology())
     except FileNotFoundError:
         st.error("Файл docs/METHODOLOGY.md не найден.")
 
@@ -120,19 +653,36 @@ with st.sidebar:
         # Form Submit Button
         submit_button = st.form_submit_button("Применить настройки")
     
-    # Process inputs outside form to ensure variables exist even if not submitted yet (using defaults or session state)
-    if round_direction_label.startswith("Вверх"):
-        activation_round_direction = "up"
-    elif round_direction_label.startswith("Вниз"):
-        activation_round_direction = "down"
-    else:
-        activation_round_direction = "nearest"
+    # Form widgets keep their last submitted values, so settings exist even before the first submit
+    settings = Settings(
+        pre_test_weeks=pre_test_weeks,
+        pre_test_threshold=pre_test_threshold,
+        contiguous_pre_test=contiguous_pre_test,
+        use_stock_filter=use_stock_filter,
+        stock_threshold_pct=threshold_pct,
+        test_use_week_values=(test_calc_mode == "Значение текущей недели"),
+        activation_threshold=activation_threshold,
+        activation_use_rounding=use_rounding,
+        activation_round_value=round_value,
+        activation_round_direction=_round_direction(round_direction_label),
+        activation_wap_from_change_date=activation_wap_from_change_date,
+        activation_min_days_threshold=min_days_threshold,
+    )
+
+# Параметры активации — один раз на rerun для вкладок, презентации и отчётов;
+# activation_key — их замороженная форма, общий ключ для всех кэшей
+activation_params = settings.activation_params()
+activation_key = tuple(activation_params.items())
 
 uploaded_file = st.file_uploader("Загрузите файл XLSX", type=['xlsx'])
 
 if uploaded_file is not None:
     try:
-        calc = EffectCalculator(uploaded_file)
+        file_bytes = uploaded_file.getvalue()
+        file_key = hashlib.md5(file_bytes).hexdigest()
+        with st.spinner('Чтение файла...'):
+            shared_calc = _load_calc(file_key, file_bytes)
+        calc = shared_calc
         summary = None
         
         # Run on first upload, on file change, or after submit
@@ -144,35 +694,11 @@ if uploaded_file is not None:
         
         if should_run:
             with st.spinner('Обработка данных и расчет...'):
-                try:
-                    # Preprocessing
-                    calc.preprocess()
-                except Exception as prep_err:
-                    prep_err._debug_stage = 'preprocess'
-                    st.session_state['debug_info'] = {
-                        'status': 'error',
-                        'stage': 'preprocess',
-                        'message': str(prep_err),
-                        'recommendation': _get_error_recommendation(prep_err)
-                    }
-                    raise
                 try:
                     # Calculation
-                    results = calc.calculate(
-                        use_stock_filter=use_stock_filter, 
-                        stock_threshold_pct=threshold_pct,
-                        pre_test_weeks_count=pre_test_weeks,
-                        pre_test_stock_threshold=pre_test_threshold,
-                        contiguous_pre_test=contiguous_pre_test,
-                        test_use_week_values=(test_calc_mode == "Значение текущей недели"),
-                        activation_threshold=activation_threshold,
-                        activation_use_rounding=use_rounding,
-                        activation_round_value=round_value,
-                        activation_round_direction=activation_round_direction,
-                        activation_wap_from_change_date=activation_wap_from_change_date,
-                        activation_min_days_threshold=min_days_threshold
-                    )
-                    summary = calc.get_summary()
+                    results, summary = _run_calc(file_key, settings, shared_calc)
+                    # Общий экземпляр (cache_resource) не трогаем — результаты сессии живут на копии
+                    calc = shared_calc.with_results(results)
                 except Exception as calc_err:
                     calc_err._debug_stage = 'calculate'
                     st.session_state['debug_info'] = {
@@ -186,14 +712,22 @@ if uploaded_file is not None:
                 # Store results in session state to persist after other interactions
                 st.session_state['results'] = results
                 st.session_state['summary'] = summary
-                st.session_state['calc_instance'] = calc  # Need instance for details
+                included_pids = set()
+                if summary:
+                    for key in ('growth_stats', 'decline_stats', 'unchanged_stats'):
+                        included_pids.update(summary.get(key, {}).get('product_ids', []))
+                st.session_state['included_pids'] = included_pids
+                st.session_state['excluded_pids'] = calc.test_product_ids - included_pids
                 st.session_state['uploaded_file_name'] = uploaded_file.name
                 st.session_state['uploaded_file_size'] = uploaded_file.size
 
                 # Отладочная информация при успехе
                 _res = getattr(calc, 'results_df', None)
                 res_df = _res if _res is not None else pd.DataFrame()
-                valid_count = (res_df['Is_Excluded'] == False).sum() if not res_df.empty and 'Is_Excluded' in res_df.columns else 0
+                valid_count = (
+                    np.count_nonzero(~res_df['Is_Excluded'].to_numpy(dtype=bool))
+                    if not res_df.empty and 'Is_Excluded' in res_df.columns else 0
+                )
                 excl_count = len(res_df) - valid_count if not res_df.empty else 0
                 st.session_state['debug_info'] = {
                     'status': 'ok',
@@ -208,55 +742,28 @@ if uploaded_file is not None:
 
                 # Генерация презентации под текущий расчёт (FIFO, последние 3)
                 try:
-                    _act_round = st.session_state.get("activation_round_direction_label", "Вверх до значения")
-                    _act_dir = "up" if _act_round.startswith("Вверх") else ("down" if _act_round.startswith("Вниз") else "nearest")
-                    _act_params = {
-                        "threshold_pct": st.session_state.get("activation_threshold", 1),
-                        "use_rounding": st.session_state.get("activation_use_rounding", True),
-                        "round_value": st.session_state.get("activation_round_value", 90),
-                        "round_direction": _act_dir,
-                        "wap_from_change_date": st.session_state.get("activation_wap_from_change_date", True),
-                        "min_days_threshold": st.session_state.get("activation_min_days_threshold", 2),
-                    }
-                    _calc_params = {
-                        "pre_test_weeks": pre_test_weeks,
-                        "pre_test_threshold": pre_test_threshold,
-                        "contiguous_pre_test": contiguous_pre_test,
-                        "use_stock_filter": use_stock_filter,
-                        "stock_threshold_pct": threshold_pct,
-                        "test_use_week_values": (test_calc_mode == "Значение текущей недели"),
-                    }
-                    stats_data = build_stats_data(
-                        calc, results, summary, _act_params, uploaded_file.name, _calc_params
-                    )
-                    valid_pids = results[results["Is_Excluded"] == False]["product_id"].unique()
-                    pid = int(valid_pids[0]) if len(valid_pids) > 0 else int(list(calc.test_product_ids)[0])
-                    pres_data = build_presentation_data(
-                        calc, results, pid, _act_params,
-                        use_week_values=(test_calc_mode == "Значение текущей недели"),
-                    )
-                    html = generate_html(stats_data, pres_data)
-                    base_dir = Path(__file__).parent
-                    fname = save_presentation_and_manage_history(html, base_dir, max_history=3)
-                    st.session_state["presentation_filename"] = fname
+                    # Те же файл и параметры (Settings хэшируемы) — HTML уже сохранён, повторно не генерируем
+                    pres_sig = (settings, file_key, uploaded_file.name)
+                    prev_fn = st.session_state.get("presentation_filename")
+                    if (
+                        st.session_state.get("pres_sig") != pres_sig
+                        or not prev_fn
+                        or not (Path(__file__).parent / "static" / prev_fn).exists()
+                    ):
+                        st.session_state["presentation_filename"] = _save_presentation(
+                            calc, results, summary, activation_params, uploaded_file.name, settings
+                        )
+                        st.session_state["pres_sig"] = pres_sig
                 except Exception as _e:
                     st.session_state["presentation_filename"] = None
+                    st.session_state.pop("pres_sig", None)
         
         # Retrieve from session state if available and not just recalculated
         elif 'results' in st.session_state and 'summary' in st.session_state:
             results = st.session_state['results']
             summary = st.session_state['summary']
-            # Update calc instance reference if needed for helper methods
-            if 'calc_instance' in st.session_state:
-                cached_calc = st.session_state['calc_instance']
-                # Check if cached instance is outdated (missing new methods)
-                if hasattr(cached_calc, 'get_wap_calculation_example'):
-                    calc = cached_calc
-                else:
-                    # Cached instance is old, refresh it
-                    with st.spinner('Обновление версии калькулятора...'):
-                        calc.preprocess()
-                        st.session_state['calc_instance'] = calc 
+            # Экземпляр calc общий (cache_resource) — результаты этой сессии привязываем к копии
+            calc = shared_calc.with_results(results)
             
         if summary: 
             if submit_button:
@@ -264,6 +771,20 @@ if uploaded_file is not None:
             else:
                 st.info("Показаны результаты предыдущего расчета.")
             
+            # Один расчёт активации на rerun — общий для вкладок 2, 3 и экспорта
+            activation_df = _activation_details(file_key, activation_key, calc)
+            # Товар из фильтра вкладки активации (он же сужает лист активации в Excel-экспорте)
+            selected_act_pid = None
+
+            # {pid: {week_start: Status}} — строится один раз на расчёт, при смене товара только поиск
+            if st.session_state.get('activation_by_pid_key') != (file_key, activation_key):
+                st.session_state['activation_by_pid'] = {
+                    pid: dict(zip(grp['week_start'], grp['Status']))
+                    for pid, grp in activation_df.groupby('product_id', sort=False)
+                } if not activation_df.empty else {}
+                st.session_state['activation_by_pid_key'] = (file_key, activation_key)
+            activation_by_pid = st.session_state['activation_by_pid']
+
             # --- SUMMARY TABS ---
             tab1, tab2, tab3, tab4, tab5 = st.tabs(["📊 Общие Результаты", "🔍 Анализ Товара", "💰 Анализ активации цен", "📋 Контрольная Группа", "📖 Отчет-история"])
             
@@ -312,10 +833,10 @@ if uploaded_file is not None:
                 
                 # Expanders for details
                 with st.expander("Детализация по переоценкам"):
-                    changes_data = pd.DataFrame(
-                        list(summary.get('products_per_change', {}).items()),
+                    changes_data = pd.DataFrame.from_records(
+                        sorted(summary.get('products_per_change', {}).items()),
                         columns=['Дата старта цены', 'Кол-во товаров']
-                    ).sort_values('Дата старта цены')
+                    )
                     st.dataframe(changes_data, use_container_width=True)
                 
                 st.markdown("### Результаты по направлениям")
@@ -344,49 +865,17 @@ if uploaded_file is not None:
                 st.header("Детальный анализ товара")
                 
                 name_map = calc.product_names.to_dict()
-                all_test_pids = sorted(list(calc.test_product_ids))
+                all_test_pids = calc.sorted_test_product_ids
                 
                 effect_map = {}
                 
-                all_results_pids = set(results['product_id'].unique()) if not results.empty else set()
-                included_pids = set()
-                if summary:
-                    for key in ('growth_stats', 'decline_stats', 'unchanged_stats'):
-                        included_pids.update(summary.get(key, {}).get('product_ids', []))
-                excluded_pids = set(all_test_pids) - included_pids
-                
-                activation_threshold = st.session_state.get("activation_threshold", 10)
-                activation_use_rounding = st.session_state.get("activation_use_rounding", False)
-                activation_round_direction_label = st.session_state.get("activation_round_direction_label", "Вверх до значения")
-                activation_round_value = st.session_state.get("activation_round_value", 90)
-                activation_wap_from_change_date = st.session_state.get("activation_wap_from_change_date", True)
-                activation_min_days_threshold = st.session_state.get("activation_min_days_threshold", 3)
+                included_pids = st.session_state['included_pids']
+                excluded_pids = st.session_state['excluded_pids']
                 
-                if activation_round_direction_label.startswith("Вверх"):
-                    activation_round_direction = "up"
-                elif activation_round_direction_label.startswith("Вниз"):
-                    activation_round_direction = "down"
-                else:
-                    activation_round_direction = "nearest"
-                
-                activation_df = calc.get_activation_details(
-                    activation_threshold,
-                    use_rounding=activation_use_rounding,
-                    round_value=activation_round_value,
-                    round_direction=activation_round_direction,
-                    wap_from_change_date=activation_wap_from_change_date,
-                    min_days_threshold=activation_min_days_threshold
-                )
-                
-                activation_status_map = {}
                 activation_not_our_weeks = 0
                 activation_not_our_products = 0
                 if not activation_df.empty:
-                    activation_status_map = {
-                        (row['product_id'], row['week_start']): row['Status']
-                        for _, row in activation_df.iterrows()
-                    }
-                    not_our_mask = activation_df['Status'].str.startswith('не та цена', na=False)
+                    not_our_mask = activation_df['Status'].str.startswith('не та цена', na=False).to_numpy()
                     activation_not_our_weeks = int(not_our_mask.sum())
                     activation_not_our_products = activation_df[not_our_mask]['product_id'].nunique()
                 
@@ -397,18 +886,19 @@ if uploaded_file is not None:
                     if 'Total_Effect_Revenue' in results.columns:
                         # Use pre-calculated Total Effect
                         # Create mapping for both revenue and profit
-                        effect_map_rev = results.drop_duplicates('product_id').set_index('product_id')['Total_Effect_Revenue'].to_dict()
-                        effect_map_prof = results.drop_duplicates('product_id').set_index('product_id')['Total_Effect_Profit'].to_dict()
+                        _per_pid = results.drop_duplicates('product_id').set_index('product_id')
+                        effect_map_rev = _per_pid['Total_Effect_Revenue'].to_dict()
+                        effect_map_prof = _per_pid['Total_Effect_Profit'].to_dict()
                     elif 'Total_Product_Effect' in results.columns:
                         effect_map_rev = results.drop_duplicates('product_id').set_index('product_id')['Total_Product_Effect'].to_dict()
                         effect_map_prof = {} # Not available
                     else:
                         # Fallback
                         col = 'Abs_Effect_Revenue' if 'Abs_Effect_Revenue' in results.columns else 'Abs_Effect'
-                        effect_map_rev = results.groupby('product_id')[col].sum().to_dict()
+                        effect_map_rev = _sum_by_pid(results, col)
                         effect_map_prof = {}
                         if 'Abs_Effect_Profit' in results.columns:
-                            effect_map_prof = results.groupby('product_id')['Abs_Effect_Profit'].sum().to_dict()
+                            effect_map_prof = _sum_by_pid(results, 'Abs_Effect_Profit')
                 
                 _g_stats = summary.get('growth_stats', {})
                 _d_stats = summary.get('decline_stats', {})
@@ -467,9 +957,7 @@ if uploaded_file is not None:
                     prod_name = calc.product_names.get(selected_pid, "Unknown")
                     
                     if not timeline.empty:
-                        timeline['activation_status'] = timeline['week_start'].apply(
-                            lambda w: activation_status_map.get((selected_pid, w), "")
-                        )
+                        timeline = _with_activation_status(timeline, activation_by_pid.get(selected_pid, {}))
                         not_our_mask = timeline['activation_status'].str.startswith('не та цена', na=False)
                         not_our_test_mask = (timeline['period_label'] == 'Test') & not_our_mask
                         timeline.loc[not_our_test_mask, 'period_label'] = 'NotOurPrice'
@@ -539,16 +1027,6 @@ if uploaded_file is not None:
                         st.info("Причины исключений: нет")
 
                     if not timeline.empty:
-                        def highlight_timeline(row):
-                            style = ['color: white'] * len(row) 
-                            label = row['period_label']
-                            if label == 'Pre-Test':
-                                return ['background-color: #ffff99; color: black'] * len(row)
-                            elif label == 'Test':
-                                return ['background-color: #90ee90; color: black'] * len(row)
-                            # LowStock_Before, LowStock_Test, NotOurPrice have no fill
-                            return style
-
                         # Use Abs_Effect_Revenue if available, else Abs_Effect
                         y_col = 'abs_effect_revenue' if 'abs_effect_revenue' in timeline.columns else 'abs_effect'
                         
@@ -586,16 +1064,24 @@ if uploaded_file is not None:
                             fmt_dict_tl['abs_effect_profit'] = '{:,.2f}'
                             
                         # Rename columns for nicer display if needed, but here we just show raw col names
-                        st.dataframe(timeline[cols].style.apply(highlight_timeline, axis=1).format(fmt_dict_tl))
+                        # Цвет строки по period_label; LowStock_Before, LowStock_Test, NotOurPrice have no fill
+                        tl_labels = timeline['period_label']
+                        tl_row_css = np.where(
+                            (tl_labels == 'Pre-Test').to_numpy(), 'background-color: #ffff99; color: black',
+                            np.where((tl_labels == 'Test').to_numpy(), 'background-color: #90ee90; color: black', 'color: white')
+                        )
+                        tl_view = timeline[cols]
+                        tl_styles = _row_style_frame(tl_row_css, tl_view)
+                        st.dataframe(tl_view.style.apply(lambda _: tl_styles, axis=None).format(fmt_dict_tl))
                         
                         fig_tl = make_subplots(specs=[[{"secondary_y": True}]])
                         
                         fig_tl.add_trace(
-                            go.Scatter(x=timeline['week_formatted'], y=timeline['product_revenue'], name="Выручка товара"),
+                            go.Scattergl(x=timeline['week_formatted'], y=timeline['product_revenue'], name="Выручка товара"),
                             secondary_y=False,
                         )
                         fig_tl.add_trace(
-                            go.Scatter(x=timeline['week_formatted'], y=timeline['avg_stock'], name="Средний остаток", line=dict(dash='dot')),
+                            go.Scattergl(x=timeline['week_formatted'], y=timeline['avg_stock'], name="Средний остаток", line=dict(dash='dot')),
                             secondary_y=True,
                         )
                         
@@ -603,7 +1089,7 @@ if uploaded_file is not None:
                         excluded_points = timeline[timeline['period_label'].isin(['LowStock_Test'])]
                         if not excluded_points.empty:
                              fig_tl.add_trace(
-                                go.Scatter(x=excluded_points['week_formatted'], y=excluded_points['avg_stock'], 
+                                go.Scattergl(x=excluded_points['week_formatted'], y=excluded_points['avg_stock'], 
                                            mode='markers', marker=dict(color='red', size=10, symbol='x'),
                                            name="LowStock Test"),
                                 secondary_y=True
@@ -623,25 +1109,15 @@ if uploaded_file is not None:
                 # Parameters moved to sidebar
                 # Only display results here
                 
-                activation_df = calc.get_activation_details(
-                    activation_threshold,
-                    use_rounding=activation_use_rounding,
-                    round_value=activation_round_value,
-                    round_direction=activation_round_direction,
-                    wap_from_change_date=activation_wap_from_change_date,
-                    min_days_threshold=activation_min_days_threshold
-                )
-                
                 if not activation_df.empty:
                     # Metrics
                     total_weeks = len(activation_df)
-                    not_ok_weeks = int((~activation_df['Can_Use_In_Analysis']).sum())
-                    not_ok_pct = (not_ok_weeks / total_weeks * 100) if total_weeks > 0 else 0
-                    
-                    products_with_not_ok = activation_df[~activation_df['Can_Use_In_Analysis']]['product_id'].nunique()
-
-                    can_use_weeks = int(activation_df['Can_Use_In_Analysis'].sum())
-                    can_use_pct = (can_use_weeks / total_weeks * 100) if total_weeks > 0 else 0
+                    not_ok_weeks, can_use_weeks, products_with_not_ok = _activation_metrics(
+                        file_key, activation_key, activation_df
+                    )
+                    # activation_df is non-empty here, so total_weeks > 0
+                    not_ok_pct = not_ok_weeks / total_weeks * 100
+                    can_use_pct = can_use_weeks / total_weeks * 100
                     
                     c1, c2, c3, c4 = st.columns(4)
                     c1.metric("Всего проверено недель", total_weeks)
@@ -728,38 +1204,34 @@ if uploaded_file is not None:
                         show_plan_unused = col3.checkbox("Plan_Price_Unused", value=True, key="act_col_unused_plan")
                         show_dev_unused = col3.checkbox("Deviation_Unused", value=True, key="act_col_unused_dev")
                     
-                    def highlight_cells(x):
+                    def highlight_cells(x, rows=slice(None)):
+                        # Masks are read for the displayed page only (rows is a positional slice)
                         # Default: white text on dark theme background
-                        df_styler = pd.DataFrame('color: white', index=x.index, columns=x.columns)
+                        css = np.full(x.shape, 'color: white', dtype=object)
+                        col_idx = {col: i for i, col in enumerate(x.columns)}
                         
                         # Row styling for weeks that cannot be used in analysis
-                        mask_bad = activation_df['Can_Use_In_Analysis'] == False
-                        df_styler.loc[mask_bad, :] = 'background-color: #ff6666; color: black'
+                        mask_bad = ~activation_df['Can_Use_In_Analysis'].to_numpy(dtype=bool)[rows]
+                        css[mask_bad, :] = 'background-color: #ff6666; color: black'
                         
                         # Cell styling for Plan_Price on price change weeks (green background)
-                        mask_change = activation_df['Is_Price_Change_Week'] == True
-                        if 'Plan_Price' in df_styler.columns:
-                            df_styler.loc[mask_change, 'Plan_Price'] = 'background-color: #66ff66; color: black; font-weight: bold'
+                        mask_change = activation_df['Is_Price_Change_Week'].to_numpy(dtype=bool)[rows]
+                        if 'Plan_Price' in col_idx:
+                            css[mask_change, col_idx['Plan_Price']] = 'background-color: #66ff66; color: black; font-weight: bold'
                         
                         # Cell styling for Is_Change when fact price changed (green background)
-                        mask_fact_change = activation_df['Is_Fact_Change'] == True
-                        if 'Is_Change' in df_styler.columns:
-                            df_styler.loc[mask_fact_change, 'Is_Change'] = 'background-color: #66ff66; color: black; font-weight: bold'
+                        mask_fact_change = activation_df['Is_Fact_Change'].to_numpy(dtype=bool)[rows]
+                        if 'Is_Change' in col_idx:
+                            css[mask_fact_change, col_idx['Is_Change']] = 'background-color: #66ff66; color: black; font-weight: bold'
 
                         # Grey text for unused columns
-                        for col in ['Plan_Price_Unused', 'Deviation_Unused']:
-                            if col in df_styler.columns:
-                                df_styler.loc[:, col] = 'color: #888888'
+                        unused_idx = [col_idx[col] for col in ('Plan_Price_Unused', 'Deviation_Unused') if col in col_idx]
+                        css[:, unused_idx] = 'color: #888888'
                         
-                        return df_styler
+                        return pd.DataFrame(css, index=x.index, columns=x.columns)
 
                     # Rename columns for display
-                    display_df = activation_df.copy()
-                    
-                    # Convert Is_Fact_Change to Yes/No
-                    display_df['Is_Change'] = display_df['Is_Fact_Change'].apply(lambda x: 'Да' if x else 'Нет')
-                    
-                    display_df = display_df.rename(columns={
+                    act_rename_map = {
                         'Plan_Price_Current': 'Plan_Price',
                         'Plan_Price_Previous': 'Plan_Price_Prev',
                         'Deviation_From_Current_Pct': 'Deviation',
@@ -767,64 +1239,73 @@ if uploaded_file is not None:
                         'Plan_Price_Unused': 'Plan_Price_Unused',
                         'Deviation_Unused_Pct': 'Deviation_Unused',
                         'Fact_Price_Change_Pct': 'Fact_Change_Pct'
-                    })
+                    }
+                    
+                    # Build display_cols based on checkboxes (order of the spec is the column order)
+                    col_spec = (
+                        ('product_id', show_product_id),
+                        ('product_name', show_product_name),
+                        ('week_formatted', show_week),
+                        ('Plan_Price', show_plan_price),
+                        ('Fact_Price', show_fact_price),
+                        ('Deviation', show_deviation),
+                        ('Status', show_status),
+                        ('Plan_Price_Prev', show_plan_price_prev),
+                        ('Deviation_Prev', show_deviation_prev),
+                        ('Fact_Price_Prev', show_fact_price_prev),
+                        ('Fact_Change_Pct', show_fact_change_pct),
+                        ('Is_Change', show_is_change),
+                        ('Plan_Price_Unused', show_plan_unused),
+                        ('Deviation_Unused', show_dev_unused),
+                        ('Fact_Cost', show_fact_cost),
+                    )
+                    display_cols = [name for name, flag in col_spec if flag]
+                    
+                    # Pagination: only the current page is formatted and styled
+                    n_act_rows = len(activation_df)
+                    page_rows = slice(None)
+                    if n_act_rows > ACT_PAGE_SIZES[0]:
+                        pg1, pg2 = st.columns(2)
+                        size_options = sorted({size for size in ACT_PAGE_SIZES if size < n_act_rows} | {n_act_rows})
+                        page_size = pg1.select_slider(
+                            "Строк на странице",
+                            options=size_options,
+                            value=min(ACT_PAGE_SIZES[1], n_act_rows)
+                        )
+                        n_pages = -(-n_act_rows // page_size)
+                        page = pg2.number_input("Страница", min_value=1, max_value=n_pages, value=1, step=1)
+                        page_rows = slice((page - 1) * page_size, page * page_size)
+                        st.caption(f"Строки {page_rows.start + 1}–{min(page_rows.stop, n_act_rows)} из {n_act_rows}")
+                    
+                    # Select only the shown columns, then rename (no full-frame copy)
+                    act_source_by_display = {v: k for k, v in act_rename_map.items()}
+                    source_cols = [act_source_by_display.get(col, col) for col in display_cols if col != 'Is_Change']
+                    display_df = activation_df[source_cols].iloc[page_rows].rename(columns=act_rename_map)
                     
-                    # Build display_cols based on checkboxes
-                    display_cols = []
-                    if show_product_id:
-                        display_cols.append('product_id')
-                    if show_product_name:
-                        display_cols.append('product_name')
-                    if show_week:
-                        display_cols.append('week_formatted')
-                    if show_plan_price:
-                        display_cols.append('Plan_Price')
-                    if show_fact_price:
-                        display_cols.append('Fact_Price')
-                    if show_deviation:
-                        display_cols.append('Deviation')
-                    if show_status:
-                        display_cols.append('Status')
-                    if show_plan_price_prev:
-                        display_cols.append('Plan_Price_Prev')
-                    if show_deviation_prev:
-                        display_cols.append('Deviation_Prev')
-                    if show_fact_price_prev:
-                        display_cols.append('Fact_Price_Prev')
-                    if show_fact_change_pct:
-                        display_cols.append('Fact_Change_Pct')
+                    # Convert Is_Fact_Change to Yes/No
                     if show_is_change:
-                        display_cols.append('Is_Change')
-                    if show_plan_unused:
-                        display_cols.append('Plan_Price_Unused')
-                    if show_dev_unused:
-                        display_cols.append('Deviation_Unused')
-                    if show_fact_cost:
-                        display_cols.append('Fact_Cost')
+                        display_df['Is_Change'] = np.where(
+                            activation_df['Is_Fact_Change'].to_numpy(dtype=bool)[page_rows], 'Да', 'Нет'
+                        )
                     
-                    # Format with custom handling for None values
-                    def format_optional(val):
-                        if pd.isna(val) or val is None:
-                            return "-"
-                        return f"{val:.2f}%"
+                    # Format numbers into strings once for the page; optional columns show "-" for None/NaN
+                    price_fmt = {'Plan_Price': '{:,.2f}', 'Fact_Price': '{:,.2f}', 'Fact_Cost': '{:,.2f}'}
+                    optional_fmt = {
+                        'Plan_Price_Prev': '{:,.2f}',
+                        'Fact_Price_Prev': '{:,.2f}',
+                        'Deviation': '{:.2f}%',
+                        'Deviation_Prev': '{:.2f}%',
+                        'Fact_Change_Pct': '{:.2f}%',
+                        'Plan_Price_Unused': '{:,.2f}',
+                        'Deviation_Unused': '{:.2f}%'
+                    }
+                    for col in display_cols:
+                        if col in price_fmt:
+                            display_df[col] = display_df[col].map(price_fmt[col].format)
+                        elif col in optional_fmt:
+                            display_df[col] = _fmt_or_dash(display_df[col], optional_fmt[col])
                     
-                    def format_price_optional(val):
-                        if pd.isna(val) or val is None:
-                            return "-"
-                        return f"{val:,.2f}"
-
-                    st.dataframe(display_df[display_cols].style.apply(highlight_cells, axis=None).format({
-                        'Plan_Price': '{:,.2f}',
-                        'Plan_Price_Prev': format_price_optional,
-                        'Fact_Price': '{:,.2f}',
-                        'Fact_Price_Prev': format_price_optional,
-                        'Deviation': format_optional,
-                        'Deviation_Prev': format_optional,
-                        'Fact_Change_Pct': format_optional,
-                        'Plan_Price_Unused': format_price_optional,
-                        'Deviation_Unused': format_optional,
-                        'Fact_Cost': '{:,.2f}'
-                    }))
+                    st.dataframe(display_df[display_cols].style.apply(highlight_cells, axis=None, rows=page_rows))
                 else:
                     st.info("Нет данных для анализа активации цен (нет тестовых товаров или продаж).")
                 
@@ -833,23 +1314,15 @@ if uploaded_file is not None:
                 st.subheader("📊 Анализ активации по переоценкам")
                 
                 # Получаем данные анализа переоценок
-                reval_summary, reval_detail = calc.analyze_revaluation_activation(
-                    activation_threshold=activation_threshold,
-                    use_rounding=activation_use_rounding,
-                    round_value=activation_round_value,
-                    round_direction=activation_round_direction,
-                    wap_from_change_date=activation_wap_from_change_date,
-                    min_days_threshold=activation_min_days_threshold
-                )
+                reval_summary, reval_detail = _revaluation_analysis(file_key, activation_key, calc)
                 
                 if not reval_summary.empty:
                     # Общая статистика по всем переоценкам
                     st.markdown("### Общая статистика")
                     total_revaluations = len(reval_summary)
-                    total_proposed = reval_summary['total_proposed'].sum()
-                    total_on_time = reval_summary['activated_on_time'].sum()
-                    total_later = reval_summary['activated_later'].sum()
-                    total_rejected = reval_summary['rejected'].sum()
+                    total_proposed, total_on_time, total_later, total_rejected = reval_summary[
+                        ['total_proposed', 'activated_on_time', 'activated_later', 'rejected']
+                    ].sum().to_numpy()
                     
                     col1, col2, col3, col4, col5 = st.columns(5)
                     col1.metric("Всего переоценок", total_revaluations)
@@ -860,25 +1333,26 @@ if uploaded_file is not None:
                     
                     # График динамики активации по переоценкам
                     st.markdown("### Динамика активации по переоценкам")
+                    x_dates = reval_summary['revaluation_date'].to_numpy()
                     fig_reval = go.Figure()
                     
                     fig_reval.add_trace(go.Bar(
-                        x=reval_summary['revaluation_date'],
-                        y=reval_summary['activated_on_time'],
+                        x=x_dates,
+                        y=reval_summary['activated_on_time'].to_numpy(),
                         name='Активировано вовремя',
                         marker_color='#2ecc71'
                     ))
                     
                     fig_reval.add_trace(go.Bar(
-                        x=reval_summary['revaluation_date'],
-                        y=reval_summary['activated_later'],
+                        x=x_dates,
+                        y=reval_summary['activated_later'].to_numpy(),
                         name='Активировано позже',
                         marker_color='#f39c12'
                     ))
                     
                     fig_reval.add_trace(go.Bar(
-                        x=reval_summary['revaluation_date'],
-                        y=reval_summary['rejected'],
+                        x=x_dates,
+                        y=reval_summary['rejected'].to_numpy(),
                         name='Отклонено',
                         marker_color='#e74c3c'
                     ))
@@ -898,8 +1372,8 @@ if uploaded_file is not None:
                     fig_rate = go.Figure()
                     
                     fig_rate.add_trace(go.Scatter(
-                        x=reval_summary['revaluation_date'],
-                        y=reval_summary['activation_rate_on_time'],
+                        x=x_dates,
+                        y=reval_summary['activation_rate_on_time'].to_numpy(),
                         mode='lines+markers',
                         name='% активации вовремя',
                         line=dict(color='#2ecc71', width=3),
@@ -907,8 +1381,8 @@ if uploaded_file is not None:
                     ))
                     
                     fig_rate.add_trace(go.Scatter(
-                        x=reval_summary['revaluation_date'],
-                        y=reval_summary['activation_rate_total'],
+                        x=x_dates,
+                        y=reval_summary['activation_rate_total'].to_numpy(),
                         mode='lines+markers',
                         name='% активации всего',
                         line=dict(color='#3498db', width=3),
@@ -930,10 +1404,16 @@ if uploaded_file is not None:
                     st.markdown("### Детальный анализ переоценки")
                     
                     # Создаем список для выбора
-                    reval_options = []
-                    for i, (idx, row) in enumerate(reval_summary.iterrows()):
-                        label = f"{row['revaluation_date'].strftime('%d.%m.%Y')} - {row['planned_week_formatted']} (Предложено: {row['total_proposed']})"
-                        reval_options.append((i, label, row['revaluation_date']))
+                    reval_dates = reval_summary['revaluation_date']
+                    reval_options = [
+                        (i, f"{date_str} - {week} (Предложено: {total})", date)
+                        for i, (date_str, week, total, date) in enumerate(zip(
+                            reval_dates.dt.strftime('%d.%m.%Y'),
+                            reval_summary['planned_week_formatted'],
+                            reval_summary['total_proposed'],
+                            reval_dates
+                        ))
+                    ]
                     
                     if reval_options:
                         selected_reval_idx = st.selectbox(
@@ -946,7 +1426,9 @@ if uploaded_file is not None:
                         selected_date = reval_options[selected_reval_idx][2]
                         
                         # Фильтруем детальные данные по выбранной переоценке
-                        detail_filtered = reval_detail[reval_detail['revaluation_date'] == selected_date].copy()
+                        detail_filtered = _reval_detail_by_date(file_key, activation_key, reval_detail).get(
+                            selected_date, pd.DataFrame()
+                        )
                         
                         if not detail_filtered.empty:
                             # Метрики для выбранной переоценки
@@ -996,8 +1478,6 @@ if uploaded_file is not None:
                             # Проверяем, какие колонки есть в данных
                             cols_to_show = [col for col in available_cols + price_cols + planned_week_cols if col in detail_filtered.columns]
                             
-                            display_detail = detail_filtered[cols_to_show].copy()
-                            
                             # Переименовываем колонки
                             rename_map = {
                                 'product_id': 'ID товара',
@@ -1016,18 +1496,15 @@ if uploaded_file is not None:
                                 'activation_status_planned_week': 'Статус (план. нед.)'
                             }
                             
-                            display_detail = display_detail.rename(columns=rename_map)
+                            display_detail = detail_filtered[cols_to_show].rename(columns=rename_map)
+                            present = set(display_detail.columns)
                             
                             # Форматируем неделю активации
-                            def format_week_display(week):
-                                if pd.isna(week) or week is None:
-                                    return "-"
-                                week_str = pd.to_datetime(week)
-                                week_end = week_str + pd.Timedelta(days=6)
-                                return f"{week_str.strftime('%d.%m.%Y')} - {week_end.strftime('%d.%m.%Y')}"
-                            
-                            if 'Неделя активации' in display_detail.columns:
-                                display_detail['Неделя активации'] = display_detail['Неделя активации'].apply(format_week_display)
+                            if 'Неделя активации' in present:
+                                week_starts = pd.to_datetime(display_detail['Неделя активации'])
+                                week_ends = week_starts + pd.Timedelta(days=6)
+                                week_labels = week_starts.dt.strftime('%d.%m.%Y') + ' - ' + week_ends.dt.strftime('%d.%m.%Y')
+                                display_detail['Неделя активации'] = week_labels.where(week_starts.notna(), '-')
                             
                             # Переводим статусы на русский
                             status_map = {
@@ -1035,77 +1512,48 @@ if uploaded_file is not None:
                                 'activated_later': 'Активировано позже',
                                 'rejected': 'Отклонено'
                             }
-                            if 'Статус активации' in display_detail.columns:
-                                display_detail['Статус активации'] = display_detail['Статус активации'].map(status_map)
-                            
-                            # Форматируем числовые значения
-                            def format_price(val):
-                                if pd.isna(val) or val is None:
-                                    return "-"
-                                return f"{val:,.2f}"
-                            
-                            def format_pct(val):
-                                if pd.isna(val) or val is None:
-                                    return "-"
-                                return f"{val:.2f}%"
+                            if 'Статус активации' in present:
+                                display_detail['Статус активации'] = pd.Categorical(
+                                    display_detail['Статус активации']
+                                ).rename_categories(status_map)
                             
                             # Применяем форматирование
                             price_cols_display = ['Плановая цена', 'Фактическая цена', 'Себестоимость', 
                                                   'План. цена (план. нед.)', 'Факт. цена (план. нед.)']
                             pct_cols_display = ['Отклонение от плана, %', 'Отклонение (план. нед.), %']
                             
-                            # Переупорядочиваем колонки для лучшей читаемости
-                            # Сначала основные, потом данные с плановой недели (если есть)
-                            col_order = ['ID товара', 'Название товара', 'Статус активации', 'Неделя активации',
-                                        'Плановая цена', 'Фактическая цена', 'Отклонение от плана, %', 
-                                        'Статус из анализа', 'Себестоимость']
-                            
-                            # Добавляем колонки с плановой недели, если они есть
-                            planned_week_cols = ['План. цена (план. нед.)', 'Факт. цена (план. нед.)', 
-                                                'Отклонение (план. нед.), %', 'Статус (план. нед.)']
-                            for col in planned_week_cols:
-                                if col in display_detail.columns:
-                                    col_order.append(col)
-                            
-                            # Добавляем оставшиеся колонки
-                            for col in display_detail.columns:
-                                if col not in col_order:
-                                    col_order.append(col)
-                            
-                            # Переупорядочиваем только существующие колонки
-                            col_order = [col for col in col_order if col in display_detail.columns]
+                            # Переупорядочиваем колонки для лучшей читаемости:
+                            # сначала основные, потом данные с плановой недели (если есть), затем остальные
+                            detail_col_template = ('ID товара', 'Название товара', 'Статус активации', 'Неделя активации',
+                                                   'Плановая цена', 'Фактическая цена', 'Отклонение от плана, %',
+                                                   'Статус из анализа', 'Себестоимость',
+                                                   'План. цена (план. нед.)', 'Факт. цена (план. нед.)',
+                                                   'Отклонение (план. нед.), %', 'Статус (план. нед.)')
+                            ordered = [col for col in detail_col_template if col in present]
+                            ordered_set = set(ordered)
+                            col_order = ordered + [col for col in display_detail.columns if col not in ordered_set]
                             if col_order:
                                 display_detail = display_detail[col_order]
                             
-                            for col in price_cols_display:
-                                if col in display_detail.columns:
-                                    display_detail[col] = display_detail[col].apply(format_price)
-                            
-                            for col in pct_cols_display:
-                                if col in display_detail.columns:
-                                    display_detail[col] = display_detail[col].apply(format_pct)
-                            
-                            # Применяем цветовую подсветку
-                            def highlight_status_row(row):
-                                colors = {
-                                    'Активировано вовремя': 'background-color: #d4edda; color: black',
-                                    'Активировано позже': 'background-color: #fff3cd; color: black',
-                                    'Отклонено': 'background-color: #f8d7da; color: black'
-                                }
-                                status = row.get('Статус активации', '')
-                                return [colors.get(status, '')] * len(row)
+                            fmt_map = {col: '{:,.2f}' for col in price_cols_display} | {col: '{:.2f}%' for col in pct_cols_display}
+                            for col, fmt in fmt_map.items():
+                                if col in present:
+                                    display_detail[col] = _fmt_or_dash(display_detail[col], fmt)
                             
-                            # Определяем формат для числовых колонок
-                            format_dict = {}
-                            for col in price_cols_display:
-                                if col in display_detail.columns:
-                                    format_dict[col] = lambda x: x  # Уже отформатировано
-                            for col in pct_cols_display:
-                                if col in display_detail.columns:
-                                    format_dict[col] = lambda x: x  # Уже отформатировано
+                            # Применяем цветовую подсветку (цвет строки по статусу)
+                            status_colors = {
+                                'Активировано вовремя': 'background-color: #d4edda; color: black',
+                                'Активировано позже': 'background-color: #fff3cd; color: black',
+                                'Отклонено': 'background-color: #f8d7da; color: black'
+                            }
+                            if 'Статус активации' in present:
+                                status_css = display_detail['Статус активации'].map(status_colors).astype(object).fillna('').to_numpy()
+                            else:
+                                status_css = np.full(len(display_detail), '', dtype=object)
+                            detail_styles = _row_style_frame(status_css, display_detail)
                             
                             st.dataframe(
-                                display_detail.style.apply(highlight_status_row, axis=1),
+                                display_detail.style.apply(lambda _: detail_styles, axis=None),
                                 use_container_width=True,
                                 hide_index=True
                             )
@@ -1124,34 +1572,42 @@ if uploaded_file is not None:
                 
                 # --- 1. Select Product ---
                 # Get list of processed products
-                processed_pids = sorted(list(results['product_id'].unique())) if not results.empty else []
+                processed_pids = _processed_pids(file_key, settings, results) if not results.empty else []
                 
                 if not processed_pids:
                     st.warning("Нет данных для анализа.")
                 else:
-                    # Helper to format dropdown options
-                    def report_format_func(pid):
-                        name = calc.product_names.get(pid, "Unknown")
-                        return f"[{pid}] {name}"
+                    # Dropdown labels, built once per file and product set
+                    label_by_pid = _product_labels(file_key, tuple(processed_pids), calc.product_names)
                     
                     # Try to find a good default (positive effect)
                     default_idx = 0
                     if not results.empty:
-                        col_eff = 'Total_Effect_Revenue' if 'Total_Effect_Revenue' in results.columns else 'Abs_Effect_Revenue'
-                        if col_eff not in results.columns: col_eff = 'Abs_Effect'
-                        best_pid = results.sort_values(col_eff, ascending=False).iloc[0]['product_id']
-                        if best_pid in processed_pids:
-                            default_idx = processed_pids.index(best_pid)
+                        col_eff = next((c for c in ('Total_Effect_Revenue', 'Abs_Effect_Revenue', 'Abs_Effect') if c in results.columns), None)
+                        if col_eff is not None:
+                            eff = results[col_eff]
+                            best_idx = eff.idxmax() if eff.notna().any() else results.index[0]
+                            best_pid = results.at[best_idx, 'product_id']
+                            if best_pid in processed_pids:
+                                default_idx = processed_pids.index(best_pid)
 
                     selected_report_pid = st.selectbox(
                         "Выберите товар для анализа:", 
                         processed_pids, 
                         index=default_idx,
-                        format_func=report_format_func,
+                        format_func=label_by_pid.__getitem__,
                         key="report_hero_select"
                     )
                     
-                    if selected_report_pid:
+                    # Исходные строки по product_id (группировка один раз на файл) и единая проверка наличия данных
+                    prices_by_pid = _rows_by_pid(file_key, 'test_prices', calc.test_prices, 'New_Price_Start')
+                    sales_by_pid = _rows_by_pid(file_key, 'sales', calc.sales, 'recorded_on')
+                    has_prices = selected_report_pid in prices_by_pid
+                    has_sales = selected_report_pid in sales_by_pid
+                    
+                    if selected_report_pid and not (has_prices or has_sales):
+                        st.warning("По выбранному товару нет ни переоценок, ни продаж.")
+                    elif selected_report_pid:
                         hero_name = calc.product_names.get(selected_report_pid, f"ID {selected_report_pid}")
                         st.subheader(f"Анализируемый товар: {hero_name}")
                         
@@ -1162,12 +1618,9 @@ if uploaded_file is not None:
                         st.markdown("### 1. Вводные данные: Переоценки")
                         
                         # Get price changes from raw data (calculator has self.test_prices)
-                        # We need to filter by product_id
-                        hero_prices = calc.test_prices[calc.test_prices['product_id'] == selected_report_pid].copy()
+                        hero_prices = prices_by_pid[selected_report_pid] if has_prices else calc.test_prices.iloc[:0]
                         
-                        if not hero_prices.empty:
-                            hero_prices = hero_prices.sort_values('New_Price_Start')
-                            
+                        if has_prices:
                             # --- Analysis Metrics ---
                             changes_count = len(hero_prices)
                             
@@ -1179,23 +1632,23 @@ if uploaded_file is not None:
                                 freq_str = f"{freq:.1f} дн."
                             
                             # Average Change % (relative to current price)
-                            hero_prices['Change_Pct'] = 0.0
-                            mask_valid = hero_prices['Current_Price'] > 0
-                            hero_prices.loc[mask_valid, 'Change_Pct'] = (
-                                (hero_prices.loc[mask_valid, 'New_Price'] - hero_prices.loc[mask_valid, 'Current_Price']) /
-                                hero_prices.loc[mask_valid, 'Current_Price'] * 100
-                            )
+                            cur_price = hero_prices['Current_Price'].to_numpy(dtype=float)
+                            new_price = hero_prices['New_Price'].to_numpy(dtype=float)
+                            change_pct = np.zeros_like(cur_price)
+                            np.divide(new_price - cur_price, cur_price, out=change_pct, where=cur_price > 0)
+                            change_pct *= 100
                             
-                            avg_change_pct = hero_prices['Change_Pct'].abs().mean()
+                            # nanmean keeps pandas' skipna semantics for missing prices
+                            avg_change_pct = np.nanmean(np.abs(change_pct))
                             
                             # Avg Change Rub (relative to current price)
-                            diffs_rub = (hero_prices['New_Price'] - hero_prices['Current_Price']).abs()
-                            avg_change_rub = diffs_rub.mean()
+                            diffs_rub = np.abs(new_price - cur_price)
+                            avg_change_rub = np.nanmean(diffs_rub)
                             
                             # Duration
                             first_date = hero_prices['New_Price_Start'].min()
                             # Find max date in sales for this product
-                            last_sale_date = calc.sales[calc.sales['product_id'] == selected_report_pid]['recorded_on'].max()
+                            last_sale_date = sales_by_pid.get(selected_report_pid, calc.sales.iloc[:0])['recorded_on'].max()
                             
                             duration_days = 0
                             if pd.notnull(last_sale_date) and last_sale_date > first_date:
@@ -1211,9 +1664,13 @@ if uploaded_file is not None:
 
                             st.markdown("Список запланированных изменений цен:")
                             
-                            # Prepare display table
-                            price_display = hero_prices[['New_Price_Start', 'New_Price', 'Current_Price', 'Change_Pct']].copy()
-                            price_display.columns = ['Дата старта', 'Новая цена', 'Текущая цена', 'Изменение %']
+                            # Prepare display table straight from the column arrays (cached group stays untouched)
+                            price_display = pd.DataFrame({
+                                'Дата старта': hero_prices['New_Price_Start'].to_numpy(),
+                                'Новая цена': hero_prices['New_Price'].to_numpy(),
+                                'Текущая цена': hero_prices['Current_Price'].to_numpy(),
+                                'Изменение %': change_pct
+                            }, index=hero_prices.index)
                             
                             st.dataframe(
                                 price_display.style
@@ -1234,22 +1691,14 @@ if uploaded_file is not None:
                         st.markdown("Детальные данные о продажах с расчетом выручки и прибыли.")
                         
                         # Get raw sales for this product
-                        hero_sales = calc.sales[calc.sales['product_id'] == selected_report_pid].copy()
+                        hero_sales = sales_by_pid[selected_report_pid] if has_sales else calc.sales.iloc[:0]
                         
-                        if not hero_sales.empty:
-                            hero_sales = hero_sales.sort_values('recorded_on')
-                            
-                            if 'cost_volume' not in hero_sales.columns:
-                                hero_sales['cost_volume'] = 0 
-                                
-                            hero_sales['profit'] = hero_sales['revenue'] - hero_sales['cost_volume']
+                        if has_sales:
+                            start_date = hero_prices['New_Price_Start'].min() if has_prices else None
                             
-                            start_date = hero_prices['New_Price_Start'].min() if not hero_prices.empty else None
-                            
-                            def highlight_sales_row(row):
-                                if start_date and row['Дата'] >= start_date:
-                                    return ['background-color: #90ee90; color: black'] * len(row)
-                                return [''] * len(row)
+                            def highlight_sales_rows(df):
+                                in_test = (df['Дата'] >= start_date).to_numpy() if start_date else np.zeros(len(df), dtype=bool)
+                                return _row_style_frame(np.where(in_test, 'background-color: #90ee90; color: black', ''), df)
                             
                             cols_show = ['recorded_on', 'price', 'quantity', 'revenue', 'cost_at_sale', 'profit']
                             cols_rename = {
@@ -1263,7 +1712,7 @@ if uploaded_file is not None:
                             
                             display_sales = hero_sales[cols_show].rename(columns=cols_rename)
                             
-                            st.dataframe(display_sales.style.apply(highlight_sales_row, axis=1).format({
+                            st.dataframe(display_sales.style.apply(highlight_sales_rows, axis=None).format({
                                 'Дата': '{:%d.%m.%Y}',
                                 'Цена продажи': '{:,.2f}',
                                 'Кол-во (шт)': '{:.0f}',
@@ -1279,69 +1728,36 @@ if uploaded_file is not None:
                         # --- 3. Input Data: Weekly Report Data ---
                         st.markdown("### 3. Вводные данные: Понедельные показатели")
                         
-                        # Retrieve params from session state or defaults
-                        activation_threshold = st.session_state.get("activation_threshold", 10)
-                        activation_use_rounding = st.session_state.get("activation_use_rounding", False)
-                        activation_round_direction_label = st.session_state.get("activation_round_direction_label", "Вверх до значения")
-                        activation_round_value = st.session_state.get("activation_round_value", 90)
-                        activation_wap_from_change_date = st.session_state.get("activation_wap_from_change_date", True)
-                        activation_min_days_threshold = st.session_state.get("activation_min_days_threshold", 3)
-                        
-                        if activation_round_direction_label.startswith("Вверх"):
-                            activation_round_direction = "up"
-                        elif activation_round_direction_label.startswith("Вниз"):
-                            activation_round_direction = "down"
-                        else:
-                            activation_round_direction = "nearest"
-
-                        activation_params = {
-                            "threshold_pct": activation_threshold,
-                            "use_rounding": activation_use_rounding,
-                            "round_value": activation_round_value,
-                            "round_direction": activation_round_direction,
-                            "wap_from_change_date": activation_wap_from_change_date,
-                            "min_days_threshold": activation_min_days_threshold
-                        }
-
-                        weekly_df = calc.get_product_weekly_report_data(selected_report_pid, activation_params)
+                        # Без продаж понедельный отчёт всегда пуст — не считаем его
+                        weekly_df = _weekly_report(file_key, selected_report_pid, activation_key, calc) if has_sales else pd.DataFrame()
                         
                         if not weekly_df.empty:
                             # Formatting helper
                             def fmt_price(x):
                                 return f"{x:,.2f}" if pd.notnull(x) else "-"
 
-                            # Styling function
-                            def highlight_weekly_row(row):
-                                if row.get('is_test_period', False):
-                                    return ['background-color: #90ee90; color: black'] * len(row)
-                                return [''] * len(row)
-
-                            cols_to_show = [
-                                'product_id', 'product_name', 'week_formatted',
-                                'Plan_price', 'Fact_price', 'Cost_price',
-                                'Суммарная выручка', 'Суммарная прибыль'
-                            ]
-                            
-                            # Prepare display dataframe with Russian names
-                            display_df = weekly_df[cols_to_show].copy()
-                            display_df.columns = [
-                                'ID товара', 'Наименование', 'Неделя',
-                                'План. цена', 'Факт. цена', 'Себест.',
-                                'Выручка (нед.)', 'Прибыль (нед.)'
-                            ]
-                            # Add hidden column for styling
-                            display_df['is_test_period'] = weekly_df['is_test_period'].values
-                            
-                            def highlight_display_row(row):
-                                # Apply style to all visible columns if test period
-                                style = [''] * len(row)
-                                if row['is_test_period']:
-                                    style = ['background-color: #90ee90; color: black'] * len(row)
-                                return style
+                            # Prepare display dataframe with Russian names (plus hidden column for styling)
+                            display_df = pd.DataFrame({
+                                'ID товара': weekly_df['product_id'].to_numpy(),
+                                'Наименование': weekly_df['product_name'].array,
+                                'Неделя': weekly_df['week_formatted'].array,
+                                'План. цена': weekly_df['Plan_price'].to_numpy(),
+                                'Факт. цена': weekly_df['Fact_price'].to_numpy(),
+                                'Себест.': weekly_df['Cost_price'].to_numpy(),
+                                'Выручка (нед.)': weekly_df['Суммарная выручка'].to_numpy(),
+                                'Прибыль (нед.)': weekly_df['Суммарная прибыль'].to_numpy(),
+                                'is_test_period': weekly_df['is_test_period'].to_numpy()
+                            }, index=weekly_df.index)
+                            
+                            def highlight_display_rows(df):
+                                # Test-period rows are green across all columns
+                                return _row_style_frame(np.where(
+                                    df['is_test_period'].to_numpy(dtype=bool), 'background-color: #90ee90; color: black', ''
+                                ), df)
 
                             st.dataframe(
                                 display_df.style
-                                .apply(highlight_display_row, axis=1)
+                                .apply(highlight_display_rows, axis=None)
                                 .format({
                                     'План. цена': fmt_price,
                                     'Факт. цена': fmt_price,
@@ -1357,96 +1773,65 @@ if uploaded_file is not None:
                             st.markdown("#### Детализация расчетов по неделям")
                             
                             # --- Iterate through ALL Test Weeks ---
-                            # Sort by date
-                            weekly_df_sorted = weekly_df.sort_values('week_start')
-                            test_weeks_df = weekly_df_sorted[weekly_df_sorted['is_test_period'] == True]
+                            # weekly_df is already ordered by week_start (get_product_weekly_report_data)
+                            test_weeks_df = weekly_df[weekly_df['is_test_period'] == True]
                             
                             if not test_weeks_df.empty:
-                                for _, row in test_weeks_df.iterrows():
-                                    week_start = row['week_start']
-                                    week_fmt = row['week_formatted']
-                                    
-                                    details = calc.get_weekly_details(selected_report_pid, week_start, activation_params)
-                                    
-                                    with st.expander(f"Детализация расчета: Неделя {week_fmt}"):
+                                # Numeric columns are pure floats; 'Дата' already comes preformatted from get_weekly_details
+                                week_detail_fmt = {
+                                    'Цена': '{:,.2f}',
+                                    'Кол-во': '{:.0f}',
+                                    'Выручка': '{:,.2f}',
+                                    'Себестоимость ед.': '{:,.2f}',
+                                    'Прибыль': '{:,.2f}'
+                                }
+                                for week_start, week_fmt in test_weeks_df[['week_start', 'week_formatted']].itertuples(index=False):
+                                    # Expander tracks its open state; details are computed only for opened weeks
+                                    with st.expander(
+                                        f"Детализация расчета: Неделя {week_fmt}",
+                                        key=f"week_details_{selected_report_pid}_{week_start:%Y%m%d}",
+                                        on_change="rerun"
+                                    ) as week_expander:
+                                        if not week_expander.open:
+                                            continue
+                                        details = _weekly_details(file_key, selected_report_pid, week_start, activation_key, calc)
+                                        
                                         # Show details even if no sales, to show structure with zeros
                                         # But keep check for display logic
                                         
                                         st.markdown("**1. Плановая цена**")
                                         st.markdown(details['plan_text'])
                                         
-                                        # Helper function for highlighting Total row cells, greying unused, and bolding used
-                                        # Use context to differentiate between 'Fact Price' (subset) and others (full sales)
-                                        def highlight_cells(row, target_col, context='full'):
-                                            styles = [''] * len(row)
-                                            
-                                            is_total = row['Дата'] == 'Итого'
-                                            is_used_price = row.get('is_used', False) # Used for price calculation
-                                            
-                                            # Determine if row is "active" based on context
-                                            # For 'price' context: active if is_used=True
-                                            # For 'full' context (Rev/Cost/Profit): active if Quantity > 0 (real sale)
-                                            
-                                            # Check quantity safely
-                                            qty = 0
-                                            if 'Кол-во' in row:
-                                                try:
-                                                    qty = float(row['Кол-во'])
-                                                except:
-                                                    qty = 0
-                                            
-                                            is_active_row = False
-                                            if context == 'price':
-                                                is_active_row = is_used_price
-                                            else:
-                                                is_active_row = qty > 0
-
-                                            # Grey out inactive rows (except Total)
-                                            if not is_total and not is_active_row:
-                                                return ['color: #aaaaaa'] * len(row)
-                                            
-                                            # Bold active rows
-                                            if not is_total and is_active_row:
-                                                styles = ['font-weight: bold'] * len(row)
-
-                                            # Highlight target in Total row
-                                            if is_total:
-                                                if target_col in row.index:
-                                                    idx = row.index.get_loc(target_col)
-                                                    styles[idx] = 'color: green; font-weight: bold'
-                                            
-                                            return styles
-
                                         st.markdown("**2. Фактическая цена**")
                                         st.write("Транзакции, вошедшие в расчет цены:")
                                         # Use standard pandas formatting via styler, handling Total row
                                         # Convert mixed types to string for formatting where needed
                                         st.dataframe(details['fact_transactions'].style
-                                            .format({
-                                                'Цена': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Кол-во': lambda x: f"{x:.0f}" if isinstance(x, (int, float)) else str(x),
-                                                'Дата': lambda x: f"{x:%d.%m.%Y}" if isinstance(x, (pd.Timestamp, datetime.date)) else str(x)
-                                            })
-                                            .apply(highlight_cells, target_col='Цена', context='price', axis=1)
+                                            .format(week_detail_fmt)
+                                            .apply(_weekly_detail_styles, target_col='Цена', context='price', axis=None)
                                             .hide(subset=['is_used'], axis="columns"), 
                                             use_container_width=True
                                         )
                                         st.markdown(details['fact_text'])
                                         
-                                        # Full Week Data for subsequent blocks
+                                        # Full Week Data for subsequent blocks: styles are computed once for the
+                                        # whole frame; each block takes its column subset and marks its own total cell
                                         full_df = details['full_transactions']
+                                        full_styles = _weekly_detail_styles(full_df, target_col=None, context='full')
+                                        full_is_total = full_df['Дата'].eq('Итого').to_numpy()
+                                        
+                                        def full_block_styler(cols, target_col):
+                                            block_styles = full_styles[cols]
+                                            block_styles.loc[full_is_total, target_col] = 'color: green; font-weight: bold'
+                                            return (full_df[cols].style
+                                                .format(week_detail_fmt)
+                                                .apply(lambda _: block_styles, axis=None)
+                                                .hide(subset=['is_used'], axis="columns"))
                                         
                                         st.markdown("**3. Выручка**")
                                         st.write("Исходные данные с расчетом выручки (Цена * Кол-во):")
-                                        st.dataframe(full_df[['Дата', 'День недели', 'Цена', 'Кол-во', 'Выручка', 'is_used']].style
-                                            .format({
-                                                'Цена': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Кол-во': lambda x: f"{x:.0f}" if isinstance(x, (int, float)) else str(x),
-                                                'Выручка': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Дата': lambda x: f"{x:%d.%m.%Y}" if isinstance(x, (pd.Timestamp, datetime.date)) else str(x)
-                                            })
-                                            .apply(highlight_cells, target_col='Выручка', context='full', axis=1)
-                                            .hide(subset=['is_used'], axis="columns"),
+                                        st.dataframe(
+                                            full_block_styler(['Дата', 'День недели', 'Цена', 'Кол-во', 'Выручка', 'is_used'], 'Выручка'),
                                             use_container_width=True
                                         )
                                         st.markdown(details['revenue_text'])
@@ -1455,41 +1840,24 @@ if uploaded_file is not None:
                                         st.write("История изменения себестоимости за период продаж:")
                                         if 'cost_source_data' in details and not details['cost_source_data'].empty:
                                             st.dataframe(details['cost_source_data'].style.format({
-                                                'Период с': lambda x: f"{x:%d.%m.%Y}" if isinstance(x, (pd.Timestamp, datetime.date)) else str(x),
-                                                'Период по': lambda x: f"{x:%d.%m.%Y}" if isinstance(x, (pd.Timestamp, datetime.date)) else str(x),
+                                                'Период с': '{:%d.%m.%Y}',
+                                                'Период по': '{:%d.%m.%Y}',
                                                 'Себестоимость': '{:,.2f}'
                                             }), use_container_width=True)
                                         else:
                                             st.write("Нет данных о себестоимости вблизи периода продаж.")
                                             
                                         st.write("Расчет средней себестоимости по транзакциям:")
-                                        st.dataframe(full_df[['Дата', 'День недели', 'Цена', 'Кол-во', 'Выручка', 'Себестоимость ед.', 'is_used']].style
-                                            .format({
-                                                'Цена': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Кол-во': lambda x: f"{x:.0f}" if isinstance(x, (int, float)) else str(x),
-                                                'Выручка': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Себестоимость ед.': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Дата': lambda x: f"{x:%d.%m.%Y}" if isinstance(x, (pd.Timestamp, datetime.date)) else str(x)
-                                            })
-                                            .apply(highlight_cells, target_col='Себестоимость ед.', context='full', axis=1)
-                                            .hide(subset=['is_used'], axis="columns"),
+                                        st.dataframe(
+                                            full_block_styler(['Дата', 'День недели', 'Цена', 'Кол-во', 'Выручка', 'Себестоимость ед.', 'is_used'], 'Себестоимость ед.'),
                                             use_container_width=True
                                         )
                                         st.markdown(details['cost_text'])
                                         
                                         st.markdown("**5. Прибыль**")
                                         st.write("Исходные данные с расчетом прибыли (Выручка - (Себ.ед * Кол-во)):")
-                                        st.dataframe(full_df[['Дата', 'День недели', 'Цена', 'Кол-во', 'Выручка', 'Себестоимость ед.', 'Прибыль', 'is_used']].style
-                                            .format({
-                                                'Цена': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Кол-во': lambda x: f"{x:.0f}" if isinstance(x, (int, float)) else str(x),
-                                                'Выручка': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Себестоимость ед.': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Прибыль': lambda x: f"{x:,.2f}" if isinstance(x, (int, float)) else str(x),
-                                                'Дата': lambda x: f"{x:%d.%m.%Y}" if isinstance(x, (pd.Timestamp, datetime.date)) else str(x)
-                                            })
-                                            .apply(highlight_cells, target_col='Прибыль', context='full', axis=1)
-                                            .hide(subset=['is_used'], axis="columns"),
+                                        st.dataframe(
+                                            full_block_styler(['Дата', 'День недели', 'Цена', 'Кол-во', 'Выручка', 'Себестоимость ед.', 'Прибыль', 'is_used'], 'Прибыль'),
                                             use_container_width=True
                                         )
                                         st.markdown(details['profit_text'])
@@ -1502,11 +1870,11 @@ if uploaded_file is not None:
                             # --- 4. Pre-Test Period Selection ---
                             st.markdown("### 4. Выбор дотестового периода")
                             
-                            pre_test_params = {
-                                'pre_test_weeks_count': pre_test_weeks,
-                                'pre_test_stock_threshold': pre_test_threshold,
-                                'contiguous_pre_test': contiguous_pre_test
-                            }
+                            pre_test_key = (
+                                ('pre_test_weeks_count', pre_test_weeks),
+                                ('pre_test_stock_threshold', pre_test_threshold),
+                                ('contiguous_pre_test', contiguous_pre_test),
+                            )
                             
                             contiguous_str = "подряд идущие" if contiguous_pre_test else "не обязательно подряд идущие"
                             
@@ -1515,27 +1883,27 @@ if uploaded_file is not None:
                             При этом важно, чтобы это были недели, когда товар был на остатке более **{pre_test_threshold}%** времени.
                             """)
                             
-                            report_min = weekly_df['week_start'].min() if not weekly_df.empty else None
-                            report_max = weekly_df['week_start'].max() if not weekly_df.empty else None
+                            # weekly_df упорядочен по week_start — границы диапазона это первая и последняя строки
+                            week_starts = weekly_df['week_start']
+                            report_min, report_max = (week_starts.iat[0], week_starts.iat[-1]) if len(week_starts) else (None, None)
                             
-                            pre_test_details = calc.get_pre_test_selection_details(
-                                selected_report_pid,
-                                pre_test_params,
-                                report_min=report_min,
-                                report_max=report_max
+                            pre_test_details = _pre_test_details(
+                                file_key, selected_report_pid, pre_test_key, report_min, report_max, calc
                             )
                             
                             if pre_test_details is not None:
                                 pre_test_df = pre_test_details.get('df')
                                 if pre_test_df is not None and not pre_test_df.empty:
-                                    def highlight_selected(row):
-                                        if row['Выбрана']:
-                                            return ['background-color: #90ee90; color: black; font-weight: bold'] * len(row)
-                                        return ['color: #888888'] * len(row)
+                                    def highlight_selected(df):
+                                        return _row_style_frame(np.where(
+                                            df['Выбрана'].to_numpy(dtype=bool),
+                                            'background-color: #90ee90; color: black; font-weight: bold',
+                                            'color: #888888'
+                                        ), df)
 
                                     st.dataframe(
                                         pre_test_df.style
-                                        .apply(highlight_selected, axis=1)
+                                        .apply(highlight_selected, axis=None)
                                         .format({
                                             'Дней на остатке': '{:.0f}',
                                             'Доступность %': '{:.1f}%',
@@ -1573,51 +1941,40 @@ if uploaded_file is not None:
                             
                             if not timeline.empty:
                                 # Enrich status similar to Product Analysis tab
-                                timeline['activation_status'] = timeline['week_start'].apply(
-                                    lambda w: activation_status_map.get((selected_report_pid, w), "")
-                                )
+                                timeline = _with_activation_status(timeline, activation_by_pid.get(selected_report_pid, {}))
                                 not_our_mask = timeline['activation_status'].str.startswith('не та цена', na=False)
                                 not_our_test_mask = (timeline['period_label'] == 'Test') & not_our_mask
                                 timeline.loc[not_our_test_mask, 'period_label'] = 'NotOurPrice'
                                 
-                                # Create display DF
-                                final_selection_df = timeline.copy()
-                                
-                                # Define Status Translation
-                                status_trans = {
-                                    'Pre-Test': 'Дотестовый (База)',
-                                    'Test': 'Тестовый (Включен)',
-                                    'LowStock_Test': 'Исключен (Мало стока)',
-                                    'LowStock_Before': 'Исключен (Мало стока до)',
-                                    'Transit': 'Исключен (Транзитная)',
-                                    'NotOurPrice': 'Исключен (Не та цена)',
-                                    'Other': 'Другое'
-                                }
-                                final_selection_df['Статус'] = final_selection_df['period_label'].map(status_trans).fillna('Другое')
-                                final_selection_df['Включена в тест'] = final_selection_df['period_label'] == 'Test'
-                                final_selection_df['Включена в базу'] = final_selection_df['period_label'] == 'Pre-Test'
+                                # period_label is categorical (PERIOD_LABELS): statuses are its renamed categories,
+                                # the inclusion flags are compares on its int8 codes
+                                period_cat = timeline['period_label'].cat
+                                period_codes = period_cat.codes.to_numpy()
+                                timeline['Статус'] = period_cat.rename_categories(PERIOD_STATUS_LABELS)
+                                timeline['Включена в тест'] = period_codes == period_cat.categories.get_loc('Test')
+                                timeline['Включена в базу'] = period_codes == period_cat.categories.get_loc('Pre-Test')
                                 
-                                cols_final = ['week_formatted', 'avg_stock', 'Статус', 'Включена в тест', 'Включена в базу']
-                                display_final = final_selection_df[cols_final].rename(columns={
-                                    'week_formatted': 'Неделя',
-                                    'avg_stock': 'Средний остаток'
-                                })
+                                display_final = timeline[list(FINAL_SELECTION_COLS)].rename(columns=FINAL_SELECTION_RENAME)
                                 
-                                def highlight_final_rows(row):
-                                    style = [''] * len(row)
-                                    status = row['Статус']
-                                    
-                                    if 'Тестовый (Включен)' in status:
-                                        return ['background-color: #90ee90; color: black; font-weight: bold'] * len(row)
-                                    elif 'Дотестовый (База)' in status:
-                                        return ['background-color: #ffff99; color: black; font-weight: bold'] * len(row)
-                                    elif 'Исключен' in status:
-                                        return ['color: #888888'] * len(row)
-                                    return style
+                                def highlight_final_rows(df):
+                                    status = df['Статус']
+                                    return _row_style_frame(np.select(
+                                        [
+                                            (status == 'Тестовый (Включен)').to_numpy(),
+                                            (status == 'Дотестовый (База)').to_numpy(),
+                                            status.str.contains('Исключен', regex=False).to_numpy(dtype=bool)
+                                        ],
+                                        [
+                                            'background-color: #90ee90; color: black; font-weight: bold',
+                                            'background-color: #ffff99; color: black; font-weight: bold',
+                                            'color: #888888'
+                                        ],
+                                        default=''
+                                    ), df)
 
                                 st.dataframe(
                                     display_final.style
-                                    .apply(highlight_final_rows, axis=1)
+                                    .apply(highlight_final_rows, axis=None)
                                     .format({'Средний остаток': '{:,.2f}'}),
                                     use_container_width=True
                                 )
@@ -1627,7 +1984,7 @@ if uploaded_file is not None:
                             # --- 6. Calculation of Effect ---
                             st.markdown("### 6. Расчет эффекта")
                             
-                            calc_mode_desc = "по каждой неделе" if (test_calc_mode == "Значение текущей недели") else "по среднему"
+                            calc_mode_desc = "по каждой неделе" if settings.test_use_week_values else "по среднему"
                             
                             st.write(f"""
                             Мы выбрали тестовый и контрольный период (дотестовый) и посчитали показатели выручки и прибыли для тестовых периодов.
@@ -1635,81 +1992,52 @@ if uploaded_file is not None:
                             Режим расчета: **{calc_mode_desc}**.
                             """)
                             
-                            use_week_values = (test_calc_mode == "Значение текущей недели")
-                            effect_details_df = calc.get_simple_effect_details(selected_report_pid, use_week_values=use_week_values)
+                            effect_details_df = _simple_effect_details(file_key, settings, selected_report_pid, calc, results)
                             
                             if not effect_details_df.empty:
-                                # Summary Table
-                                summary_cols = [
-                                    'week_formatted', 
-                                    'Fact_Revenue_Real', 'PreTest_Avg_Revenue', 
-                                    'Uplift_Revenue_Pct',
-                                    'Fact_Profit_Real', 'PreTest_Avg_Profit',
-                                    'Uplift_Profit_Pct'
-                                ]
-                                
-                                display_effect = effect_details_df[summary_cols].rename(columns={
-                                    'week_formatted': 'Неделя',
-                                    'Fact_Revenue_Real': 'Выручка (Test)',
-                                    'PreTest_Avg_Revenue': 'Выручка (Pre-Test Avg)',
-                                    'Uplift_Revenue_Pct': 'Прирост % (Rev)',
-                                    'Fact_Profit_Real': 'Прибыль (Test)',
-                                    'PreTest_Avg_Profit': 'Прибыль (Pre-Test Avg)',
-                                    'Uplift_Profit_Pct': 'Прирост % (Prof)'
-                                })
-                                
+                                # Summary tables (cached per file, settings and product)
+                                (
+                                    display_effect, display_control, display_net, display_abs_with_total,
+                                    net_styles, abs_styles, effect_text
+                                ) = _effect_tables(
+                                    file_key, settings, selected_report_pid, effect_details_df
+                                )
                                 st.dataframe(
-                                    display_effect.style.format({
-                                        'Выручка (Test)': '{:,.2f}',
-                                        'Выручка (Pre-Test Avg)': '{:,.2f}',
-                                        'Прирост % (Rev)': '{:+.2f}%',
-                                        'Прибыль (Test)': '{:,.2f}',
-                                        'Прибыль (Pre-Test Avg)': '{:,.2f}',
-                                        'Прирост % (Prof)': '{:+.2f}%'
-                                    }),
+                                    display_effect.style
+                                    .format('{:,.2f}', subset=['Выручка (Test)', 'Выручка (Pre-Test Avg)', 'Прибыль (Test)', 'Прибыль (Pre-Test Avg)'])
+                                    .format('{:+.2f}%', subset=['Прирост % (Rev)', 'Прирост % (Prof)']),
                                     use_container_width=True
                                 )
                                 
                                 st.markdown("#### Детализация расчета по неделям (Тестовая группа)")
                                 
-                                for _, row in effect_details_df.iterrows():
-                                    week_fmt = row['week_formatted']
-                                    mode_cmt = row['Mode_Comment']
-                                    
-                                    # Revenue Values
-                                    calc_rev = row['Calc_Revenue']
-                                    base_rev = row['PreTest_Avg_Revenue']
-                                    uplift_rev = row['Uplift_Revenue_Pct']
-                                    
-                                    # Profit Values
-                                    calc_prof = row['Calc_Profit']
-                                    base_prof = row['PreTest_Avg_Profit']
-                                    uplift_prof = row['Uplift_Profit_Pct']
-                                    
-                                    with st.expander(f"Расчет прироста (Test): Неделя {week_fmt}"):
-                                        c1, c2 = st.columns(2)
+                                # Fragment: toggling a week expander reruns only this group, not the whole report;
+                                # collapsed expanders skip their body
+                                @st.fragment
+                                def test_uplift_expanders():
+                                    week_columns = (
+                                        'week_key', 'week_formatted', 'test_revenue_md', 'test_profit_md'
+                                    )
+                                    for week_key, week_fmt, revenue_md, profit_md in zip(
+                                        *(effect_text[col] for col in week_columns)
+                                    ):
+                                        with st.expander(
+                                            f"Расчет прироста (Test): Неделя {week_fmt}",
+                                            key=f"effect_test_{week_key}",
+                                            on_change="rerun"
+                                        ) as effect_expander:
+                                            if not effect_expander.open:
+                                                continue
+                                            c1, c2 = st.columns(2)
                                         
-                                        with c1:
-                                            st.markdown("**1. Эффект по Выручке**")
-                                            st.markdown(f"""
-                                            **Формула:** `(Fact_Revenue / PreTest_Avg) - 1`
-                                            
-                                            *   **Fact Revenue** {mode_cmt} = `{calc_rev:,.2f} ₽`
-                                            *   **Pre-Test Avg** (база) = `{base_rev:,.2f} ₽`
+                                            with c1:
+                                                st.markdown("**1. Эффект по Выручке**")
+                                                st.markdown(revenue_md)
                                             
-                                            **Прирост (Uplift)** = `({calc_rev:,.2f} / {base_rev:,.2f}) - 1` = :green[**{uplift_rev*100:+.2f}%**]
-                                            """)
-                                            
-                                        with c2:
-                                            st.markdown("**2. Эффект по Прибыли**")
-                                            st.markdown(f"""
-                                            **Формула:** `(Fact_Profit / PreTest_Avg) - 1`
-                                            
-                                            *   **Fact Profit** {mode_cmt} = `{calc_prof:,.2f} ₽`
-                                            *   **Pre-Test Avg** (база) = `{base_prof:,.2f} ₽`
-                                            
-                                            **Прирост (Uplift)** = `({calc_prof:,.2f} / {base_prof:,.2f}) - 1` = :green[**{uplift_prof*100:+.2f}%**]
-                                            """)
+                                            with c2:
+                                                st.markdown("**2. Эффект по Прибыли**")
+                                                st.markdown(profit_md)
+                                test_uplift_expanders()
 
                                 # --- Control Group & Net Effect ---
                                 st.markdown("### 6.2 Контрольная группа и Чистый эффект")
@@ -1722,126 +2050,50 @@ if uploaded_file is not None:
                                 2. Вычитаем прирост КГ из прироста Теста, чтобы получить **Чистый Эффект**.
                                 """)
                                 
-                                # Control Group Table
-                                summary_cols_control = [
-                                    'week_formatted',
-                                    'Control_Revenue_Real', 'Control_Avg_Revenue',
-                                    'Control_Uplift_Revenue_Pct',
-                                    'Control_Profit_Real', 'Control_Avg_Profit',
-                                    'Control_Uplift_Profit_Pct'
-                                ]
-                                
-                                display_control = effect_details_df[summary_cols_control].rename(columns={
-                                    'week_formatted': 'Неделя',
-                                    'Control_Revenue_Real': 'Выручка (КГ)',
-                                    'Control_Avg_Revenue': 'Выручка (КГ База)',
-                                    'Control_Uplift_Revenue_Pct': 'Прирост % (КГ Rev)',
-                                    'Control_Profit_Real': 'Прибыль (КГ)',
-                                    'Control_Avg_Profit': 'Прибыль (КГ База)',
-                                    'Control_Uplift_Profit_Pct': 'Прирост % (КГ Prof)'
-                                })
-                                
                                 st.dataframe(
-                                    display_control.style.format({
-                                        'Выручка (КГ)': '{:,.2f}',
-                                        'Выручка (КГ База)': '{:,.2f}',
-                                        'Прирост % (КГ Rev)': '{:+.2f}%',
-                                        'Прибыль (КГ)': '{:,.2f}',
-                                        'Прибыль (КГ База)': '{:,.2f}',
-                                        'Прирост % (КГ Prof)': '{:+.2f}%'
-                                    }),
+                                    display_control.style
+                                    .format('{:,.2f}', subset=['Выручка (КГ)', 'Выручка (КГ База)', 'Прибыль (КГ)', 'Прибыль (КГ База)'])
+                                    .format('{:+.2f}%', subset=['Прирост % (КГ Rev)', 'Прирост % (КГ Prof)']),
                                     use_container_width=True
                                 )
                                 
                                 st.markdown("#### Детализация расчета по неделям (Контрольная группа)")
                                 
-                                for _, row in effect_details_df.iterrows():
-                                    week_fmt = row['week_formatted']
-                                    mode_cmt = row['Mode_Comment']
-                                    
-                                    # Control Revenue Values
-                                    calc_rev_c = row['Calc_Control_Revenue']
-                                    base_rev_c = row['Control_Avg_Revenue']
-                                    uplift_rev_c = row['Control_Uplift_Revenue_Pct']
-                                    
-                                    # Control Profit Values
-                                    calc_prof_c = row['Calc_Control_Profit']
-                                    base_prof_c = row['Control_Avg_Profit']
-                                    uplift_prof_c = row['Control_Uplift_Profit_Pct']
-                                    
-                                    with st.expander(f"Расчет прироста (КГ): Неделя {week_fmt}"):
-                                        c1, c2 = st.columns(2)
+                                # Fragment: toggling a week expander reruns only this group
+                                @st.fragment
+                                def control_uplift_expanders():
+                                    week_columns = (
+                                        'week_key', 'week_formatted', 'control_revenue_md', 'control_profit_md'
+                                    )
+                                    for week_key, week_fmt, revenue_md, profit_md in zip(
+                                        *(effect_text[col] for col in week_columns)
+                                    ):
+                                        with st.expander(
+                                            f"Расчет прироста (КГ): Неделя {week_fmt}",
+                                            key=f"effect_control_{week_key}",
+                                            on_change="rerun"
+                                        ) as effect_expander:
+                                            if not effect_expander.open:
+                                                continue
+                                            c1, c2 = st.columns(2)
                                         
-                                        with c1:
-                                            st.markdown("**1. Прирост КГ по Выручке**")
-                                            st.markdown(f"""
-                                            **Формула:** `(Control_Fact / Control_Base) - 1`
-                                            
-                                            *   **Control Fact** {mode_cmt} = `{calc_rev_c:,.2f} ₽`
-                                            *   **Control Base** (база) = `{base_rev_c:,.2f} ₽`
-                                            
-                                            **Прирост (Uplift)** = `({calc_rev_c:,.2f} / {base_rev_c:,.2f}) - 1` = :blue[**{uplift_rev_c*100:+.2f}%**]
-                                            """)
+                                            with c1:
+                                                st.markdown("**1. Прирост КГ по Выручке**")
+                                                st.markdown(revenue_md)
                                             
-                                        with c2:
-                                            st.markdown("**2. Прирост КГ по Прибыли**")
-                                            st.markdown(f"""
-                                            **Формула:** `(Control_Fact / Control_Base) - 1`
-                                            
-                                            *   **Control Fact** {mode_cmt} = `{calc_prof_c:,.2f} ₽`
-                                            *   **Control Base** (база) = `{base_prof_c:,.2f} ₽`
-                                            
-                                            **Прирост (Uplift)** = `({calc_prof_c:,.2f} / {base_prof_c:,.2f}) - 1` = :blue[**{uplift_prof_c*100:+.2f}%**]
-                                            """)
+                                            with c2:
+                                                st.markdown("**2. Прирост КГ по Прибыли**")
+                                                st.markdown(profit_md)
+                                control_uplift_expanders()
                                 
                                 # Net Effect Table
                                 st.markdown("#### Итоговый чистый прирост")
                                 st.write("Вычитаем прирост Контрольной Группы из прироста Теста:")
                                 
-                                summary_cols_net = [
-                                    'week_formatted',
-                                    'Uplift_Revenue_Pct', 'Control_Uplift_Revenue_Pct', 'Net_Effect_Revenue_Pct',
-                                    'Uplift_Profit_Pct', 'Control_Uplift_Profit_Pct', 'Net_Effect_Profit_Pct'
-                                ]
-                                
-                                display_net = effect_details_df[summary_cols_net].rename(columns={
-                                    'week_formatted': 'Неделя',
-                                    'Uplift_Revenue_Pct': 'Test % (Rev)',
-                                    'Control_Uplift_Revenue_Pct': 'Control % (Rev)',
-                                    'Net_Effect_Revenue_Pct': 'Чистый Эффект % (Rev)',
-                                    'Uplift_Profit_Pct': 'Test % (Prof)',
-                                    'Control_Uplift_Profit_Pct': 'Control % (Prof)',
-                                    'Net_Effect_Profit_Pct': 'Чистый Эффект % (Prof)'
-                                })
-                                
-                                def highlight_net_effect(row):
-                                    # Highlight Net Effect columns
-                                    styles = [''] * len(row)
-                                    if 'Чистый Эффект % (Rev)' in row.index:
-                                        idx_r = row.index.get_loc('Чистый Эффект % (Rev)')
-                                        val_r = row['Чистый Эффект % (Rev)']
-                                        color_r = '#90ee90' if val_r > 0 else '#ffcccc'
-                                        styles[idx_r] = f'background-color: {color_r}; color: black; font-weight: bold'
-                                        
-                                    if 'Чистый Эффект % (Prof)' in row.index:
-                                        idx_p = row.index.get_loc('Чистый Эффект % (Prof)')
-                                        val_p = row['Чистый Эффект % (Prof)']
-                                        color_p = '#90ee90' if val_p > 0 else '#ffcccc'
-                                        styles[idx_p] = f'background-color: {color_p}; color: black; font-weight: bold'
-                                    
-                                    return styles
-
                                 st.dataframe(
                                     display_net.style
-                                    .apply(highlight_net_effect, axis=1)
-                                    .format({
-                                        'Test % (Rev)': '{:+.2f}%',
-                                        'Control % (Rev)': '{:+.2f}%',
-                                        'Чистый Эффект % (Rev)': '{:+.2f}%',
-                                        'Test % (Prof)': '{:+.2f}%',
-                                        'Control % (Prof)': '{:+.2f}%',
-                                        'Чистый Эффект % (Prof)': '{:+.2f}%'
-                                    }),
+                                    .apply(lambda _: net_styles, axis=None)
+                                    .format('{:+.2f}%', subset=display_net.columns[1:]),
                                     use_container_width=True
                                 )
                                 # --- Absolute Net Effect ---
@@ -1855,109 +2107,49 @@ if uploaded_file is not None:
                                 *Формула:* `Net_Abs_Effect = Net_Effect_% * Fact_Test_Metric`
                                 """)
                                 
-                                summary_cols_abs = [
-                                    'week_formatted',
-                                    'Net_Effect_Revenue_Pct', 'Fact_Revenue_Real', 'Net_Abs_Effect_Revenue',
-                                    'Net_Effect_Profit_Pct', 'Fact_Profit_Real', 'Net_Abs_Effect_Profit'
-                                ]
-                                
-                                display_abs = effect_details_df[summary_cols_abs].rename(columns={
-                                    'week_formatted': 'Неделя',
-                                    'Net_Effect_Revenue_Pct': 'Чистый % (Rev)',
-                                    'Fact_Revenue_Real': 'Факт (Test Rev)',
-                                    'Net_Abs_Effect_Revenue': 'Абс. Эффект (Rev)',
-                                    'Net_Effect_Profit_Pct': 'Чистый % (Prof)',
-                                    'Fact_Profit_Real': 'Факт (Test Prof)',
-                                    'Net_Abs_Effect_Profit': 'Абс. Эффект (Prof)'
-                                })
-                                
-                                def highlight_abs_effect(row):
-                                    styles = [''] * len(row)
-                                    # Highlight Absolute Effect columns
-                                    for col in ['Абс. Эффект (Rev)', 'Абс. Эффект (Prof)']:
-                                        if col in row.index:
-                                            idx = row.index.get_loc(col)
-                                            val = row[col]
-                                            # Use simple green/red logic
-                                            color = '#90ee90' if val > 0 else '#ffcccc'
-                                            # If zero, maybe neutral?
-                                            if val == 0: color = ''
-                                            else:
-                                                styles[idx] = f'background-color: {color}; color: black; font-weight: bold'
-                                    return styles
-
-                                # Add Total row
-                                total_row_abs = pd.DataFrame([{
-                                    'Неделя': 'ИТОГО',
-                                    'Чистый % (Rev)': effect_details_df['Net_Effect_Revenue_Pct'].mean(),
-                                    'Факт (Test Rev)': effect_details_df['Fact_Revenue_Real'].sum(),
-                                    'Абс. Эффект (Rev)': effect_details_df['Net_Abs_Effect_Revenue'].sum(),
-                                    'Чистый % (Prof)': effect_details_df['Net_Effect_Profit_Pct'].mean(),
-                                    'Факт (Test Prof)': effect_details_df['Fact_Profit_Real'].sum(),
-                                    'Абс. Эффект (Prof)': effect_details_df['Net_Abs_Effect_Profit'].sum()
-                                }])
-                                display_abs_with_total = pd.concat([display_abs, total_row_abs], ignore_index=True)
-                                
-                                def highlight_abs_effect_with_total(row):
-                                    styles = [''] * len(row)
-                                    is_total = row['Неделя'] == 'ИТОГО'
-                                    
-                                    if is_total:
-                                        # Bold all cells in total row
-                                        styles = ['font-weight: bold'] * len(row)
-                                    
-                                    # Highlight Absolute Effect columns
-                                    for col in ['Абс. Эффект (Rev)', 'Абс. Эффект (Prof)']:
-                                        if col in row.index:
-                                            idx = row.index.get_loc(col)
-                                            val = row[col]
-                                            if val != 0:
-                                                color = '#90ee90' if val > 0 else '#ffcccc'
-                                                styles[idx] = f'background-color: {color}; color: black; font-weight: bold'
-                                    return styles
-
                                 st.dataframe(
                                     display_abs_with_total.style
-                                    .apply(highlight_abs_effect_with_total, axis=1)
-                                    .format({
-                                        'Чистый % (Rev)': '{:+.2f}%',
-                                        'Факт (Test Rev)': '{:,.2f}',
-                                        'Абс. Эффект (Rev)': '{:,.2f}',
-                                        'Чистый % (Prof)': '{:+.2f}%',
-                                        'Факт (Test Prof)': '{:,.2f}',
-                                        'Абс. Эффект (Prof)': '{:,.2f}'
-                                    }),
+                                    .apply(lambda _: abs_styles, axis=None)
+                                    .format('{:,.2f}', subset=['Факт (Test Rev)', 'Абс. Эффект (Rev)', 'Факт (Test Prof)', 'Абс. Эффект (Prof)'])
+                                    .format('{:+.2f}%', subset=['Чистый % (Rev)', 'Чистый % (Prof)']),
                                     use_container_width=True
                                 )
                                 
                                 st.markdown("#### Детализация абсолютного эффекта по неделям")
-                                for _, row in effect_details_df.iterrows():
-                                    week_fmt = row['week_formatted']
-                                    
-                                    net_pct_rev = row['Net_Effect_Revenue_Pct']
-                                    fact_rev = row['Fact_Revenue_Real']
-                                    abs_rev = row['Net_Abs_Effect_Revenue']
-                                    
-                                    net_pct_prof = row['Net_Effect_Profit_Pct']
-                                    fact_prof = row['Fact_Profit_Real']
-                                    abs_prof = row['Net_Abs_Effect_Profit']
-                                    
-                                    with st.expander(f"Расчет абс. эффекта: Неделя {week_fmt}"):
-                                        c1, c2 = st.columns(2)
-                                        with c1:
-                                            st.markdown("**Выручка**")
-                                            st.markdown(f"`{net_pct_rev*100:+.2f}%` * `{fact_rev:,.2f} ₽` = :green[**{abs_rev:,.2f} ₽**]")
-                                        with c2:
-                                            st.markdown("**Прибыль**")
-                                            st.markdown(f"`{net_pct_prof*100:+.2f}%` * `{fact_prof:,.2f} ₽` = :green[**{abs_prof:,.2f} ₽**]")
+                                # Fragment: toggling a week expander reruns only this group
+                                @st.fragment
+                                def abs_effect_expanders():
+                                    week_columns = (
+                                        'week_key', 'week_formatted', 'abs_revenue_md', 'abs_profit_md'
+                                    )
+                                    for week_key, week_fmt, revenue_md, profit_md in zip(
+                                        *(effect_text[col] for col in week_columns)
+                                    ):
+                                        with st.expander(
+                                            f"Расчет абс. эффекта: Неделя {week_fmt}",
+                                            key=f"effect_abs_{week_key}",
+                                            on_change="rerun"
+                                        ) as effect_expander:
+                                            if not effect_expander.open:
+                                                continue
+                                            c1, c2 = st.columns(2)
+                                            with c1:
+                                                st.markdown("**Выручка**")
+                                                st.markdown(revenue_md)
+                                            with c2:
+                                                st.markdown("**Прибыль**")
+                                                st.markdown(profit_md)
+                                abs_effect_expanders()
                                 
                                 # --- Summary / Итоги ---
                                 st.markdown("### 7. Итоги")
                                 
-                                total_abs_revenue = effect_details_df['Net_Abs_Effect_Revenue'].sum()
-                                total_abs_profit = effect_details_df['Net_Abs_Effect_Profit'].sum()
-                                avg_pct_revenue = effect_details_df['Net_Effect_Revenue_Pct'].mean() * 100
-                                avg_pct_profit = effect_details_df['Net_Effect_Profit_Pct'].mean() * 100
+                                total_abs_revenue, total_abs_profit, avg_pct_revenue, avg_pct_profit = effect_details_df.agg({
+                                    'Net_Abs_Effect_Revenue': 'sum',
+                                    'Net_Abs_Effect_Profit': 'sum',
+                                    'Net_Effect_Revenue_Pct': 'mean',
+                                    'Net_Effect_Profit_Pct': 'mean'
+                                }).to_numpy() * (1, 1, 100, 100)
                                 
                                 st.success(f"""
                                 **Итого данная позиция принесла:**
@@ -2024,10 +2216,10 @@ if uploaded_file is not None:
                         
                         # Expanders for details
                         with st.expander("Детализация по переоценкам"):
-                            changes_data = pd.DataFrame(
-                                list(summary.get('products_per_change', {}).items()),
+                            changes_data = pd.DataFrame.from_records(
+                                sorted(summary.get('products_per_change', {}).items()),
                                 columns=['Дата старта цены', 'Кол-во товаров']
-                            ).sort_values('Дата старта цены')
+                            )
                             st.dataframe(changes_data, use_container_width=True)
                         
                         st.markdown("### Результаты по направлениям")
@@ -2056,26 +2248,10 @@ if uploaded_file is not None:
                         st.markdown("---")
                         col_export, _ = st.columns([1, 3])
                         with col_export:
-                            # Collect params for generator
-                            report_params = {
-                                'pre_test_weeks_count': pre_test_weeks,
-                                'pre_test_stock_threshold': pre_test_threshold,
-                                'contiguous_pre_test': contiguous_pre_test,
-                                'test_use_week_values': (test_calc_mode == "Значение текущей недели")
-                            }
-                            
-                            generator = WordReportGenerator(
-                                calc, 
-                                selected_report_pid, 
-                                report_params, 
-                                results_summary=summary,
-                                activation_params=activation_params
-                            )
-                            docx_file = generator.generate()
-                            
+                            # Document is built only when the button is pressed (deferred data), then served from cache
                             st.download_button(
                                 label="📄 Скачать отчет в Word",
-                                data=docx_file,
+                                data=partial(_word_report, file_key, settings, selected_report_pid, calc, results, summary),
                                 file_name=f"report_{selected_report_pid}.docx",
                                 mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                             )
@@ -2086,91 +2262,66 @@ if uploaded_file is not None:
             st.markdown("---")
             st.subheader("Экспорт результатов")
             
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                pd.DataFrame([summary]).to_excel(writer, sheet_name='Summary', index=False)
-                if not results.empty:
-                    results.to_excel(writer, sheet_name='Detailed Results', index=False)
-                
-                if 'activation_df' in locals() and not activation_df.empty:
-                    activation_df.to_excel(writer, sheet_name='Activation Analysis', index=False)
-                
-                calc.get_control_group_info().to_excel(writer, sheet_name='Control Group', index=False)
-                
-                all_timelines = []
-                for pid in all_test_pids: 
-                    tl = calc.get_product_timeline(pid)
-                    if not tl.empty:
-                        tl['product_id'] = pid
-                        tl['product_name'] = calc.product_names.get(pid, "Unknown")
-                        all_timelines.append(tl)
-                
-                if all_timelines:
-                    pd.concat(all_timelines).to_excel(writer, sheet_name='Product Timelines', index=False)
-                
-            buffer.seek(0)
-            st.download_button(
-                label="📥 Скачать полный отчет (Excel)",
-                data=buffer,
-                file_name="pricing_effect_final.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            export_format = st.radio(
+                "Формат выгрузки:",
+                ["Excel", "Parquet", "Feather"],
+                horizontal=True,
+                key="export_format",
+                help="Excel — полный отчёт по листам; Parquet/Feather — только детальные результаты, в разы быстрее и компактнее."
             )
+            # Files are built only when the button is pressed (deferred data), then served from cache
+            if export_format == "Excel":
+                st.download_button(
+                    label="📥 Скачать полный отчет (Excel)",
+                    data=partial(_excel_export, file_key, settings, selected_act_pid, calc, results, summary, activation_df),
+                    file_name="pricing_effect_final.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+            else:
+                st.download_button(
+                    label=f"📥 Скачать детальные результаты ({export_format})",
+                    data=partial(_results_export, file_key, settings, export_format, results),
+                    file_name=f"pricing_effect_results.{export_format.lower()}",
+                    mime="application/octet-stream"
+                )
 
             pres_fn = st.session_state.get("presentation_filename")
-            if pres_fn is None:
+            # Presentation is built after each calculation; if that failed, rebuild only on request
+            if pres_fn is None and st.button("Сгенерировать презентацию", key="pres_generate"):
                 try:
-                    _act_round = st.session_state.get("activation_round_direction_label", "Вверх до значения")
-                    _act_dir = "up" if _act_round.startswith("Вверх") else ("down" if _act_round.startswith("Вниз") else "nearest")
-                    _act_params = {
-                        "threshold_pct": st.session_state.get("activation_threshold", 1),
-                        "use_rounding": st.session_state.get("activation_use_rounding", True),
-                        "round_value": st.session_state.get("activation_round_value", 90),
-                        "round_direction": _act_dir,
-                        "wap_from_change_date": st.session_state.get("activation_wap_from_change_date", True),
-                        "min_days_threshold": st.session_state.get("activation_min_days_threshold", 2),
-                    }
-                    _calc_params = {
-                        "pre_test_weeks": pre_test_weeks,
-                        "pre_test_threshold": pre_test_threshold,
-                        "contiguous_pre_test": contiguous_pre_test,
-                        "use_stock_filter": use_stock_filter,
-                        "stock_threshold_pct": threshold_pct,
-                        "test_use_week_values": (test_calc_mode == "Значение текущей недели"),
-                    }
-                    stats_data = build_stats_data(calc, results, summary, _act_params, st.session_state.get("uploaded_file_name", "файл.xlsx"), _calc_params)
-                    valid_pids = results[results["Is_Excluded"] == False]["product_id"].unique()
-                    pid = int(valid_pids[0]) if len(valid_pids) > 0 else int(list(calc.test_product_ids)[0])
-                    pres_data = build_presentation_data(calc, results, pid, _act_params, use_week_values=(test_calc_mode == "Значение текущей недели"))
-                    html = generate_html(stats_data, pres_data)
-                    pres_fn = save_presentation_and_manage_history(html, Path(__file__).parent, max_history=3)
+                    pres_fn = _save_presentation(calc, results, summary, activation_params, uploaded_file.name, settings)
                     st.session_state["presentation_filename"] = pres_fn
+                    st.session_state["pres_sig"] = (settings, file_key, uploaded_file.name)
                 except Exception:
                     pres_fn = None
             if pres_fn:
                 static_path = Path(__file__).parent / "static" / pres_fn
                 if static_path.exists():
-                    html_bytes = static_path.read_bytes()
+                    # Files are read only when a download is clicked (deferred data), then served from cache
                     st.download_button(
                         label="📊 Скачать и открыть презентацию по расчету",
-                        data=html_bytes,
+                        data=partial(_file_bytes, str(static_path), static_path.stat().st_mtime),
                         file_name=pres_fn,
                         mime="text/html",
                         help="Скачайте файл и откройте в браузере — все данные уже встроены",
                     )
-                    pdf_fn = static_path.with_suffix(".pdf").name
-                    try:
-                        pdf_path = export_html_to_pdf(static_path, static_path.with_suffix(".pdf"))
-                        pdf_bytes = pdf_path.read_bytes()
+                    # Chromium render takes seconds: only on request, and once per presentation content
+                    pdf_path = static_path.with_suffix(".pdf")
+                    if not pdf_path.exists() and st.button("Сгенерировать PDF", key="pdf_generate"):
+                        try:
+                            html_digest = hashlib.blake2b(static_path.read_bytes(), digest_size=16).hexdigest()
+                            pdf_path.write_bytes(_presentation_pdf(html_digest, static_path))
+                        except Exception as pdf_err:
+                            st.caption(f"PDF недоступен: {pdf_err}")
+                    if pdf_path.exists():
                         st.download_button(
                             label="📄 Скачать презентацию в PDF",
-                            data=pdf_bytes,
-                            file_name=pdf_fn,
+                            data=partial(_file_bytes, str(pdf_path), pdf_path.stat().st_mtime),
+                            file_name=pdf_path.name,
                             mime="application/pdf",
                             help="PDF через Playwright (Chromium), 1 слайд = 1 страница",
                             key="pdf_dl",
                         )
-                    except Exception as pdf_err:
-                        st.caption(f"PDF недоступен: {pdf_err}")
             
             # --- WORD EXPORT ---
             # Button is inside Tab 5 now.
@@ -1,10 +1,61 @@
 import pandas as pd
 import numpy as np
 import datetime
+import copy
+
+try:
+    import python_calamine  # noqa: F401 — Rust-парсер XLSX, в разы быстрее openpyxl
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = None  # pandas выберет openpyxl
+
+# Timeline period labels; NotOurPrice is assigned later from activation statuses (app / Word report)
+PERIOD_LABELS = pd.CategoricalDtype(
+    ['Pre-Test', 'Test', 'LowStock_Test', 'LowStock_Before', 'Transit', 'NotOurPrice', 'Other']
+)
+
+# Display names of the period labels (section 5 of the app and the Word report)
+PERIOD_STATUS_LABELS = {
+    'Pre-Test': 'Дотестовый (База)',
+    'Test': 'Тестовый (Включен)',
+    'LowStock_Test': 'Исключен (Мало стока)',
+    'LowStock_Before': 'Исключен (Мало стока до)',
+    'Transit': 'Исключен (Транзитная)',
+    'NotOurPrice': 'Исключен (Не та цена)',
+    'Other': 'Другое'
+}
+
+
+def _round_prices(prices, round_value, round_direction):
+    """
+    Векторное округление плановых цен до round_value копеек.
+    Неположительные цены -> NaN; целые цены и цены, уже равные целевым копейкам, не меняются.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    valid = prices > 0
+    safe = np.where(valid, prices, 0.0)
+    whole = np.trunc(safe)
+    frac = safe - whole
+    target = round_value / 100.0
+
+    if round_direction == "nearest":
+        lower = whole + target
+        upper = whole + 1 + target
+        rounded = np.where(np.abs(safe - lower) <= np.abs(safe - upper), lower, upper)
+    elif round_direction == "down":
+        rounded = np.where(frac >= target, whole + target, whole - 1 + target)
+    else:  # "up"
+        rounded = np.where(frac <= target, whole + target, whole + 1 + target)
+
+    # If already rounded to target value, don't change
+    rounded = np.where(np.abs(frac - target) < 0.01, safe, rounded)
+    rounded = np.where(frac < 1e-6, whole, rounded)
+    return np.where(valid, rounded, np.nan)
+
 
 class EffectCalculator:
     def __init__(self, file_path_or_buffer):
-        self.xl = pd.ExcelFile(file_path_or_buffer)
+        self.xl = pd.ExcelFile(file_path_or_buffer, engine=EXCEL_ENGINE)
         self.test_prices = pd.read_excel(self.xl, 'Тестовые цены')
         self.sales = pd.read_excel(self.xl, 'Продажи')
         self.costs = pd.read_excel(self.xl, 'Себестоимость') # Contains stock data
@@ -54,18 +105,21 @@ class EffectCalculator:
         # Calculate revenue for each transaction
         self.sales['revenue'] = self.sales['price'] * self.sales['quantity']
         self.sales['cost_volume'] = self.sales['cost_at_sale'] * self.sales['quantity']
+        self.sales['profit'] = self.sales['revenue'] - self.sales['cost_volume']
         
         # Align dates to Week Start (Monday)
         self.sales['week_start'] = self.sales['recorded_on'].apply(lambda x: x - pd.Timedelta(days=x.weekday())).dt.normalize()
         self.costs['week_start'] = self.costs['date'].apply(lambda x: x - pd.Timedelta(days=x.weekday())).dt.normalize()
         
-        # Determine Product Names mapping
+        # Determine Product Names mapping (Arrow-backed strings: contiguous buffer, cheap to ship to st.dataframe)
+        self.sales['name_full'] = self.sales['name_full'].astype('string[pyarrow]')
         self.product_names = self.sales.groupby('product_id')['name_full'].first()
         
         # Identify Control and Test products
         self.all_products = set(self.sales['product_id'].unique())
         self.test_product_ids = set(self.test_prices['product_id'].unique())
         self.control_product_ids = self.all_products - self.test_product_ids
+        self.sorted_test_product_ids = sorted(self.test_product_ids)
         
         # Aggregate Sales by Product and Week
         self.weekly_sales = self.sales.groupby(['product_id', 'week_start']).agg({
@@ -286,35 +340,16 @@ class EffectCalculator:
                 round_value = 0
             round_value = max(0, min(99, int(round_value)))
 
-            def round_price(price):
-                if price is None or price <= 0:
-                    return None
-                whole = int(price)
-                frac = price - whole
-                if frac < 1e-6:
-                    return float(whole)
-                target = round_value / 100.0
-                
-                # If already rounded to target value, don't change
-                if abs(frac - target) < 0.01:
-                    return price
-                
-                if round_direction == "nearest":
-                    # Round to nearest target value
-                    lower = float(whole) + target
-                    upper = float(whole + 1) + target
-                    # Choose closer one
-                    if abs(price - lower) <= abs(price - upper):
-                        return lower
-                    return upper
-                elif round_direction == "down":
-                    if frac >= target:
-                        return float(whole) + target
-                    return float(whole - 1) + target
-                else:  # "up"
-                    if frac <= target:
-                        return float(whole) + target
-                    return float(whole + 1) + target
+            # Plan prices of the product: raw and rounded, computed once for all weeks
+            plan_prices_raw = product_prices['New_Price'].tolist()
+            plan_prices_rounded = [
+                None if np.isnan(p) else p
+                for p in _round_prices(plan_prices_raw, round_value, round_direction).tolist()
+            ]
+            plan_starts = product_prices['New_Price_Start']
+            plan_starts_np = plan_starts.to_numpy()
+            # Monday of each price change week
+            plan_change_weeks = (plan_starts - pd.to_timedelta(plan_starts.dt.weekday, unit='D')).dt.normalize().to_numpy()
             
             # Initialize prev_fact_price with last known price BEFORE test period
             prev_fact_price = None
@@ -330,50 +365,38 @@ class EffectCalculator:
 
             for w in test_weeks:
                 week_end = w + pd.Timedelta(days=6)
-                active_price_rows = product_prices[product_prices['New_Price_Start'] <= week_end]
-                if active_price_rows.empty:
+                # Prices are sorted by start date, so the active ones form a prefix
+                n_active = int((plan_starts_np <= week_end.to_datetime64()).sum())
+                if n_active == 0:
                     continue 
                 
-                current_record = active_price_rows.iloc[-1]
-                plan_price_current_raw = current_record['New_Price']
+                plan_price_current_raw = plan_prices_raw[n_active - 1]
                 
-                # Collect ALL plan prices for this product
-                all_plan_prices_raw = active_price_rows['New_Price'].tolist()
-                
-                if len(active_price_rows) >= 2:
-                    plan_price_previous_raw = active_price_rows.iloc[-2]['New_Price']
+                if n_active >= 2:
+                    plan_price_previous_raw = plan_prices_raw[n_active - 2]
                 else:
                     plan_price_previous_raw = None
 
                 if use_rounding:
-                    plan_price_current = round_price(plan_price_current_raw)
-                    plan_price_previous = round_price(plan_price_previous_raw) if plan_price_previous_raw is not None else None
+                    plan_price_current = plan_prices_rounded[n_active - 1]
+                    plan_price_previous = plan_prices_rounded[n_active - 2] if plan_price_previous_raw is not None else None
                     plan_price_unused = plan_price_current_raw
                     # Apply rounding to all plan prices
-                    all_plan_prices_processed = [round_price(p) for p in all_plan_prices_raw]
+                    all_plan_prices_processed = plan_prices_rounded[:n_active]
                 else:
                     plan_price_current = plan_price_current_raw
                     plan_price_previous = plan_price_previous_raw
-                    plan_price_unused = round_price(plan_price_current_raw)
-                    all_plan_prices_processed = all_plan_prices_raw
+                    plan_price_unused = plan_prices_rounded[n_active - 1]
+                    all_plan_prices_processed = plan_prices_raw[:n_active]
                 
                 # Check if this week is a Price Change Week FIRST
-                is_price_change_week = not product_prices[
-                    product_prices['New_Price_Start'].apply(
-                        lambda x: (x - pd.Timedelta(days=x.weekday())).normalize()
-                    ) == w
-                ].empty
+                change_idx = np.flatnonzero(plan_change_weeks == w.to_datetime64())
+                is_price_change_week = len(change_idx) > 0
                 
                 # Get the price change date if exists
                 price_change_date = None
                 if is_price_change_week:
-                    change_rows = product_prices[
-                        product_prices['New_Price_Start'].apply(
-                            lambda x: (x - pd.Timedelta(days=x.weekday())).normalize()
-                        ) == w
-                    ]
-                    if not change_rows.empty:
-                        price_change_date = change_rows.iloc[0]['New_Price_Start']
+                    price_change_date = plan_starts.iloc[change_idx[0]]
                 
                 # Get actual sales data for CURRENT week
                 first_occurrence_date = None  # Track for status annotation
@@ -925,13 +948,42 @@ class EffectCalculator:
                 'is_test_period': is_test_period
             })
             
-        return pd.DataFrame(result_rows)
+        return pd.DataFrame(result_rows).astype({'product_name': 'string[pyarrow]', 'week_formatted': 'string[pyarrow]'})
 
     def get_weekly_details(self, pid, week, params):
         """
         Returns a dict with details for calculation of Price, Cost, Revenue, Profit.
         Used for detailed report breakdown.
         """
+        product_prices = self.test_prices[self.test_prices['product_id'] == pid].sort_values('New_Price_Start')
+        week_sales = self.sales[
+            (self.sales['product_id'] == pid) & 
+            (self.sales['week_start'] == week)
+        ]
+        product_costs = self.costs[self.costs['product_id'] == pid]
+        return self._weekly_details_from(pid, week, params, product_prices, week_sales, product_costs)
+
+    def get_weekly_details_batch(self, pid, week_starts, params):
+        """
+        get_weekly_details for several weeks of one product: prices, sales and costs
+        are filtered by product once and sales are split by week in a single groupby.
+        Returns {week_start: details}.
+        """
+        product_prices = self.test_prices[self.test_prices['product_id'] == pid].sort_values('New_Price_Start')
+        product_sales = self.sales[self.sales['product_id'] == pid]
+        product_costs = self.costs[self.costs['product_id'] == pid]
+        sales_by_week = dict(list(product_sales.groupby('week_start', sort=False)))
+        empty_sales = product_sales.iloc[:0]
+        return {
+            week: self._weekly_details_from(
+                pid, week, params, product_prices, sales_by_week.get(week, empty_sales), product_costs
+            )
+            for week in week_starts
+        }
+
+    def _weekly_details_from(self, pid, week, params, product_prices, week_sales, product_costs):
+        # Body of get_weekly_details over pre-filtered frames:
+        # product_prices sorted by New_Price_Start, week_sales/product_costs already limited to pid
         
         # Unpack params
         threshold_pct = params.get('threshold_pct', 10)
@@ -942,7 +994,6 @@ class EffectCalculator:
         min_days_threshold = params.get('min_days_threshold', 3)
         
         # --- 1. Plan Price Logic ---
-        product_prices = self.test_prices[self.test_prices['product_id'] == pid].sort_values('New_Price_Start')
         week_end = week + pd.Timedelta(days=6)
         active_price_rows = product_prices[product_prices['New_Price_Start'] <= week_end]
         
@@ -1026,10 +1077,7 @@ class EffectCalculator:
              method_description = "Стандартный (средняя за неделю)"
 
         used_transactions = pd.DataFrame()
-        week_sales = self.sales[
-            (self.sales['product_id'] == pid) & 
-            (self.sales['week_start'] == week)
-        ].sort_values('recorded_on')
+        week_sales = week_sales.sort_values('recorded_on')
         
         if week_sales.empty:
              return {
@@ -1184,9 +1232,13 @@ class EffectCalculator:
             week_sales_full['is_used'] = False
 
         
+        # Display dates are formatted once (vectorized) and shared by both tables; the total row holds 'Итого'
+        date_labels = week_sales_full['recorded_on'].dt.strftime('%d.%m.%Y')
+
         # Fact Price Table (Fact_Price, Quantity, Day)
         fact_display_transactions = week_sales_full[['recorded_on', 'day_name', 'price', 'quantity', 'is_used']].copy()
         fact_display_transactions.columns = ['Дата', 'День недели', 'Цена', 'Кол-во', 'is_used']
+        fact_display_transactions['Дата'] = date_labels
         
         # Add Total row
         total_row_fact = pd.DataFrame([{
@@ -1201,6 +1253,7 @@ class EffectCalculator:
         # Prepare transactions df for display (FULL week sales - Revenue, Cost, Profit)
         display_transactions = week_sales_full[['recorded_on', 'day_name', 'price', 'quantity', 'revenue', 'unit_cost', 'profit', 'is_used']].copy()
         display_transactions.columns = ['Дата', 'День недели', 'Цена', 'Кол-во', 'Выручка', 'Себестоимость ед.', 'Прибыль', 'is_used']
+        display_transactions['Дата'] = date_labels
         
         # Calculate totals for full week
         # Need to handle NaN/0 correctly in week_sales
@@ -1243,10 +1296,9 @@ class EffectCalculator:
         
         # Fetch relevant cost records (e.g. 2 weeks lookback to show where cost came from)
         search_start = min_sale_date - pd.Timedelta(days=14)
-        relevant_costs = self.costs[
-            (self.costs['product_id'] == pid) & 
-            (self.costs['date'] >= search_start) & 
-            (self.costs['date'] <= max_sale_date)
+        relevant_costs = product_costs[
+            (product_costs['date'] >= search_start) & 
+            (product_costs['date'] <= max_sale_date)
         ].sort_values('date')
         
         # Group costs by period to simplify display
@@ -1734,6 +1786,19 @@ class EffectCalculator:
                 
         return self.results_df
 
+    def with_results(self, results_df=None):
+        """
+        Shallow copy of the calculator bound to its own results_df.
+        The preprocessed tables are shared (read-only), so a cached instance can serve
+        several sessions: calculate() and results are kept on the copy only.
+        """
+        calc = copy.copy(self)
+        if results_df is not None:
+            calc.results_df = results_df
+        else:
+            calc.__dict__.pop('results_df', None)
+        return calc
+
     def get_summary(self):
         if not hasattr(self, 'results_df') or self.results_df.empty:
             return None
@@ -1882,23 +1947,29 @@ class EffectCalculator:
     def get_control_group_info(self):
         if not hasattr(self, 'control_product_ids'):
             return pd.DataFrame()
-        control_list = []
-        for pid in self.control_product_ids:
-            control_list.append({
-                'product_id': pid,
-                'name': self.product_names.get(pid, "Unknown")
-            })
-        return pd.DataFrame(control_list)
+        # The control group is fixed by preprocess(): build the frame once and share it (read-only)
+        if not hasattr(self, '_control_group_info'):
+            control_list = []
+            for pid in self.control_product_ids:
+                control_list.append({
+                    'product_id': pid,
+                    'name': self.product_names.get(pid, "Unknown")
+                })
+            self._control_group_info = pd.DataFrame(control_list)
+        return self._control_group_info
 
-    def get_simple_effect_details(self, pid, use_week_values=True):
+    def get_simple_effect_details(self, pid, use_week_values=True, results_df=None):
         """
         Calculates simple effect (Test vs Pre-Test) metrics for each valid test week.
+        results_df defaults to the results of the last calculate().
         Returns a DataFrame with details.
         """
-        if not hasattr(self, 'results_df') or self.results_df.empty:
+        if results_df is None:
+            results_df = getattr(self, 'results_df', None)
+        if results_df is None or results_df.empty:
             return pd.DataFrame()
             
-        prod_res = self.results_df[self.results_df['product_id'] == pid]
+        prod_res = results_df[results_df['product_id'] == pid]
         if prod_res.empty:
             return pd.DataFrame()
             
@@ -1912,35 +1983,19 @@ class EffectCalculator:
         if not isinstance(pre_test_weeks, list):
             pre_test_weeks = []
             
+        # Weekly revenue/cost of the product and of the control group, indexed by week once
+        # (both tables have one row per week); weeks without sales read as 0
+        prod_weekly = self.weekly_sales[self.weekly_sales['product_id'] == pid].set_index('week_start')[['revenue', 'cost_volume']]
+        control_weekly = self.control_weekly_sales.set_index('week_start')[['control_revenue', 'control_cost_volume']]
+        
         p_tb = 0
         p_cb = 0
-        valid_count = 0
         if pre_test_weeks:
-            for w in pre_test_weeks:
-                # Test Product Base Profit
-                sales_row = self.weekly_sales[
-                    (self.weekly_sales['product_id'] == pid) & 
-                    (self.weekly_sales['week_start'] == w)
-                ]
-                if not sales_row.empty:
-                    rev = sales_row['revenue'].sum()
-                    cost = sales_row['cost_volume'].sum() if 'cost_volume' in sales_row.columns else 0
-                    p_tb += (rev - cost)
-                
-                # Control Group Base Profit
-                control_row = self.control_weekly_sales[
-                    self.control_weekly_sales['week_start'] == w
-                ]
-                if not control_row.empty:
-                    rev_c = control_row['control_revenue'].sum()
-                    cost_c = control_row['control_cost_volume'].sum() if 'control_cost_volume' in control_row.columns else 0
-                    p_cb += (rev_c - cost_c)
-                    
-                valid_count += 1
-                
-            if valid_count > 0:
-                p_tb /= valid_count
-                p_cb /= valid_count
+            # Base profit = mean weekly (revenue - cost) over the pre-test weeks
+            base = prod_weekly.reindex(pre_test_weeks, fill_value=0)
+            base_c = control_weekly.reindex(pre_test_weeks, fill_value=0)
+            p_tb = (base['revenue'].to_numpy() - base['cost_volume'].to_numpy()).sum() / len(pre_test_weeks)
+            p_cb = (base_c['control_revenue'].to_numpy() - base_c['control_cost_volume'].to_numpy()).sum() / len(pre_test_weeks)
         
         # Filter for valid test weeks only
         valid_test_weeks_df = prod_res[prod_res['Is_Excluded'] == False]
@@ -1958,100 +2013,84 @@ class EffectCalculator:
             avg_control_rev = valid_test_weeks_df['Control_Fact_Revenue'].mean()
             avg_control_prof = valid_test_weeks_df['Control_Profit'].mean()
         
-        effect_rows = []
+        if valid_test_weeks_df.empty:
+            return pd.DataFrame()
         
-        for _, row in valid_test_weeks_df.iterrows():
-            week = row['week_start']
-            
-            # --- 1. Test Group Data ---
-            sales_row = self.weekly_sales[
-                (self.weekly_sales['product_id'] == pid) & 
-                (self.weekly_sales['week_start'] == week)
-            ]
-            fact_rev_real = 0
-            fact_profit_real = 0
-            if not sales_row.empty:
-                fact_rev_real = sales_row['revenue'].sum()
-                cost_vol = sales_row['cost_volume'].sum() if 'cost_volume' in sales_row.columns else 0
-                fact_profit_real = fact_rev_real - cost_vol
-            
-            # --- 2. Control Group Data ---
-            control_row = self.control_weekly_sales[
-                self.control_weekly_sales['week_start'] == week
-            ]
-            control_rev_real = 0
-            control_profit_real = 0
-            if not control_row.empty:
-                control_rev_real = control_row['control_revenue'].sum()
-                cost_c = control_row['control_cost_volume'].sum() if 'control_cost_volume' in control_row.columns else 0
-                control_profit_real = control_rev_real - cost_c
-
-            # Determine values used for calculation based on mode
-            if use_week_values:
-                calc_rev = fact_rev_real
-                calc_prof = fact_profit_real
-                calc_control_rev = control_rev_real
-                calc_control_prof = control_profit_real
-                mode_comment = "(по этой неделе)"
-            else:
-                calc_rev = avg_test_rev
-                calc_prof = avg_test_prof
-                calc_control_rev = avg_control_rev
-                calc_control_prof = avg_control_prof
-                mode_comment = "(среднее за тест)"
-            
-            # --- 3. Uplift Calculations ---
-            
-            # Test Uplifts
-            uplift_rev_pct = (calc_rev / r_tb - 1) if r_tb != 0 else 0
-            uplift_prof_pct = (calc_prof / p_tb - 1) if p_tb != 0 else 0
-            
-            # Control Uplifts
-            uplift_control_rev_pct = (calc_control_rev / r_cb - 1) if r_cb != 0 else 0
-            uplift_control_prof_pct = (calc_control_prof / p_cb - 1) if p_cb != 0 else 0
-            
-            # Net Effects (Simple Difference)
-            net_effect_rev = uplift_rev_pct - uplift_control_rev_pct
-            net_effect_prof = uplift_prof_pct - uplift_control_prof_pct
-            
-            # Net Absolute Effects (Formula: Net_Effect_% * Fact_Real)
-            # As per request: "like in Analysis of Goods" -> Effect % * Fact
-            net_abs_rev = net_effect_rev * fact_rev_real
-            net_abs_prof = net_effect_prof * fact_profit_real
-            
-            effect_rows.append({
-                'week_formatted': row['week_formatted'],
-                'week_start': week,
-                'Mode_Comment': mode_comment,
-                
-                # Test Values
-                'Fact_Revenue_Real': fact_rev_real,
-                'Fact_Profit_Real': fact_profit_real,
-                'Calc_Revenue': calc_rev,
-                'Calc_Profit': calc_prof,
-                'PreTest_Avg_Revenue': r_tb,
-                'PreTest_Avg_Profit': p_tb,
-                'Uplift_Revenue_Pct': uplift_rev_pct,
-                'Uplift_Profit_Pct': uplift_prof_pct,
-                
-                # Control Values
-                'Control_Revenue_Real': control_rev_real,
-                'Control_Profit_Real': control_profit_real,
-                'Calc_Control_Revenue': calc_control_rev,
-                'Calc_Control_Profit': calc_control_prof,
-                'Control_Avg_Revenue': r_cb,
-                'Control_Avg_Profit': p_cb,
-                'Control_Uplift_Revenue_Pct': uplift_control_rev_pct,
-                'Control_Uplift_Profit_Pct': uplift_control_prof_pct,
-                
-                # Net Effects
-                'Net_Effect_Revenue_Pct': net_effect_rev,
-                'Net_Effect_Profit_Pct': net_effect_prof,
-                'Net_Abs_Effect_Revenue': net_abs_rev,
-                'Net_Abs_Effect_Profit': net_abs_prof
-            })
-            
-        return pd.DataFrame(effect_rows)
+        # --- 1./2. Test and Control Group Data for all valid test weeks at once ---
+        test_weeks = valid_test_weeks_df['week_start']
+        # Columns are read one by one so integer sums stay integer (the Word report formats them differently)
+        fact = prod_weekly.reindex(test_weeks, fill_value=0)
+        fact_c = control_weekly.reindex(test_weeks, fill_value=0)
+        fact_rev_real = fact['revenue'].to_numpy()
+        fact_profit_real = fact_rev_real - fact['cost_volume'].to_numpy()
+        control_rev_real = fact_c['control_revenue'].to_numpy()
+        control_profit_real = control_rev_real - fact_c['control_cost_volume'].to_numpy()
+
+        # Determine values used for calculation based on mode (averages are scalars broadcast over weeks)
+        if use_week_values:
+            calc_rev = fact_rev_real
+            calc_prof = fact_profit_real
+            calc_control_rev = control_rev_real
+            calc_control_prof = control_profit_real
+            mode_comment = "(по этой неделе)"
+        else:
+            calc_rev = avg_test_rev
+            calc_prof = avg_test_prof
+            calc_control_rev = avg_control_rev
+            calc_control_prof = avg_control_prof
+            mode_comment = "(среднее за тест)"
+        
+        # --- 3. Uplift Calculations (bases are per-product scalars, so the zero check is done once) ---
+        
+        # Test Uplifts
+        uplift_rev_pct = (calc_rev / r_tb - 1) if r_tb != 0 else 0
+        uplift_prof_pct = (calc_prof / p_tb - 1) if p_tb != 0 else 0
+        
+        # Control Uplifts
+        uplift_control_rev_pct = (calc_control_rev / r_cb - 1) if r_cb != 0 else 0
+        uplift_control_prof_pct = (calc_control_prof / p_cb - 1) if p_cb != 0 else 0
+        
+        # Net Effects (Simple Difference)
+        net_effect_rev = uplift_rev_pct - uplift_control_rev_pct
+        net_effect_prof = uplift_prof_pct - uplift_control_prof_pct
+        
+        # Net Absolute Effects (Formula: Net_Effect_% * Fact_Real)
+        # As per request: "like in Analysis of Goods" -> Effect % * Fact
+        net_abs_rev = net_effect_rev * fact_rev_real
+        net_abs_prof = net_effect_prof * fact_profit_real
+        
+        # Scalars (per-product bases, mode averages) are broadcast to every week
+        return pd.DataFrame({
+            'week_formatted': valid_test_weeks_df['week_formatted'].to_numpy(),
+            'week_start': test_weeks.to_numpy(),
+            'Mode_Comment': mode_comment,
+            
+            # Test Values
+            'Fact_Revenue_Real': fact_rev_real,
+            'Fact_Profit_Real': fact_profit_real,
+            'Calc_Revenue': calc_rev,
+            'Calc_Profit': calc_prof,
+            'PreTest_Avg_Revenue': r_tb,
+            'PreTest_Avg_Profit': p_tb,
+            'Uplift_Revenue_Pct': uplift_rev_pct,
+            'Uplift_Profit_Pct': uplift_prof_pct,
+            
+            # Control Values
+            'Control_Revenue_Real': control_rev_real,
+            'Control_Profit_Real': control_profit_real,
+            'Calc_Control_Revenue': calc_control_rev,
+            'Calc_Control_Profit': calc_control_prof,
+            'Control_Avg_Revenue': r_cb,
+            'Control_Avg_Profit': p_cb,
+            'Control_Uplift_Revenue_Pct': uplift_control_rev_pct,
+            'Control_Uplift_Profit_Pct': uplift_control_prof_pct,
+            
+            # Net Effects
+            'Net_Effect_Revenue_Pct': net_effect_rev,
+            'Net_Effect_Profit_Pct': net_effect_prof,
+            'Net_Abs_Effect_Revenue': net_abs_rev,
+            'Net_Abs_Effect_Profit': net_abs_prof
+        })
 
     def get_product_timeline(self, pid):
         if not hasattr(self, 'results_df') or pid not in self.test_product_ids:
@@ -2164,4 +2203,26 @@ class EffectCalculator:
                 'is_excluded': period_label in ['LowStock_Test', 'LowStock_Before']
             })
             
-        return pd.DataFrame(timeline)
+        timeline = pd.DataFrame(timeline)
+        if not timeline.empty:
+            timeline['period_label'] = timeline['period_label'].astype(PERIOD_LABELS)
+        return timeline
+
+    def get_all_product_timelines(self, pids):
+        """
+        get_product_timeline for several products in one frame: timelines are concatenated once
+        and product_id / product_name are filled by np.repeat over the per-product lengths.
+        Products without a timeline are skipped; returns an empty DataFrame if none has one.
+        """
+        timelines = [(pid, self.get_product_timeline(pid)) for pid in pids]
+        timelines = [(pid, tl) for pid, tl in timelines if not tl.empty]
+        if not timelines:
+            return pd.DataFrame()
+        found_pids = [pid for pid, _ in timelines]
+        lengths = [len(tl) for _, tl in timelines]
+        all_timelines = pd.concat([tl for _, tl in timelines])
+        all_timelines['product_id'] = np.repeat(found_pids, lengths)
+        # One reindex of the name map instead of a Series.get per product
+        names = self.product_names.reindex(found_pids).fillna("Unknown").to_numpy(dtype=object)
+        all_timelines['product_name'] = np.repeat(names, lengths)
+        return all_timelines
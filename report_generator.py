@@ -6,6 +6,7 @@ from docx.oxml.ns import nsdecls
 from docx.oxml import parse_xml
 import io
 import datetime
+from calculator import PERIOD_STATUS_LABELS
 
 class WordReportGenerator:
     def __init__(self, calc_instance, product_id, params, results_summary=None, activation_params=None):
@@ -148,9 +149,6 @@ class WordReportGenerator:
         
         if not hero_sales.empty:
             hero_sales = hero_sales.sort_values('recorded_on')
-            if 'cost_volume' not in hero_sales.columns:
-                hero_sales['cost_volume'] = 0
-            hero_sales['profit'] = hero_sales['revenue'] - hero_sales['cost_volume']
             
             display_sales = hero_sales[['recorded_on', 'price', 'quantity', 'revenue', 'cost_at_sale', 'profit']]
             self._create_table_from_df(display_sales, column_map={
@@ -190,13 +188,17 @@ class WordReportGenerator:
             
             test_weeks_df = weekly_df[weekly_df['is_test_period'] == True]
             if not test_weeks_df.empty:
+                # The report needs every test week, so fetch them in one batch
+                details_by_week = self.calc.get_weekly_details_batch(
+                    self.pid, test_weeks_df['week_start'].tolist(), self.activation_params
+                )
                 for _, row in test_weeks_df.iterrows():
                     week_start = row['week_start']
                     week_fmt = row['week_formatted']
                     
                     self._add_heading(f"Неделя: {week_fmt}", 3)
                     
-                    details = self.calc.get_weekly_details(self.pid, week_start, self.activation_params)
+                    details = details_by_week[week_start]
                     
                     # 1. Plan Price
                     self._add_paragraph("1. Плановая цена", bold=True)
@@ -287,28 +289,18 @@ class WordReportGenerator:
             
             # Re-calculate activation map for this product locally
             act_df = self.calc.get_activation_details(specific_pid=self.pid, **self.activation_params)
-            act_map = {}
+            status_by_week = {}
             if not act_df.empty:
-                act_map = {(r['product_id'], r['week_start']): r['Status'] for _, r in act_df.iterrows()}
+                status_by_week = dict(zip(act_df['week_start'], act_df['Status']))
             
-            timeline['activation_status'] = timeline['week_start'].apply(
-                lambda w: act_map.get((self.pid, w), "")
-            )
+            timeline['activation_status'] = timeline['week_start'].map(status_by_week).fillna("").astype('category')
             not_our_mask = timeline['activation_status'].str.startswith('не та цена', na=False)
             not_our_test_mask = (timeline['period_label'] == 'Test') & not_our_mask
             timeline.loc[not_our_test_mask, 'period_label'] = 'NotOurPrice'
             
             # Add Display Columns
-            status_trans = {
-                'Pre-Test': 'Дотестовый (База)',
-                'Test': 'Тестовый (Включен)',
-                'LowStock_Test': 'Исключен (Мало стока)',
-                'LowStock_Before': 'Исключен (Мало стока до)',
-                'Transit': 'Исключен (Транзитная)',
-                'NotOurPrice': 'Исключен (Не та цена)',
-                'Other': 'Другое'
-            }
-            timeline['Статус'] = timeline['period_label'].map(status_trans).fillna('Другое')
+            # period_label is categorical with every label covered by PERIOD_STATUS_LABELS, so the map has no gaps
+            timeline['Статус'] = timeline['period_label'].map(PERIOD_STATUS_LABELS)
             
             display_df = timeline[['week_formatted', 'avg_stock', 'Статус']]
             self._create_table_from_df(display_df, column_map={